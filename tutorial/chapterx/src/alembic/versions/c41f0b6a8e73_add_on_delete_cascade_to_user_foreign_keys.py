@@ -0,0 +1,37 @@
+"""add on delete cascade to user foreign keys
+
+Revision ID: c41f0b6a8e73
+Revises: 5d1e7c3b9f20
+Create Date: 2026-10-18 16:02:19.774530
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41f0b6a8e73'
+down_revision = '5d1e7c3b9f20'
+branch_labels = None
+depends_on = None
+
+# ユーザーの削除時に、DB側で削除する行の外部キー
+TARGETS = [('items', 'user_id'), ('user_roles', 'user_id')]
+
+
+def _replace_foreign_key(table: str, column: str, ondelete) -> None:
+    # 初期テーブルの外部キーは名前を指定せずに作成したため、MySQLが付けた名前 (items_ibfk_1 など) を調べる
+    foreign_keys = sa.inspect(op.get_bind()).get_foreign_keys(table)
+    name = next(fk['name'] for fk in foreign_keys if fk['constrained_columns'] == [column])
+    op.drop_constraint(name, table, type_='foreignkey')
+    op.create_foreign_key(name, table, 'users', [column], ['id'], ondelete=ondelete)
+
+
+def upgrade() -> None:
+    for table, column in TARGETS:
+        _replace_foreign_key(table, column, 'CASCADE')
+
+
+def downgrade() -> None:
+    for table, column in TARGETS:
+        _replace_foreign_key(table, column, None)
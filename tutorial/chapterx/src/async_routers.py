@@ -0,0 +1,437 @@
+from typing import List, Optional
+from datetime import timedelta, datetime
+
+from sqlalchemy import and_, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import update as sql_update, delete as sql_delete  # アイテムの更新・削除APIの関数名と区別する
+from sqlalchemy.orm import selectinload, undefer
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import Depends, APIRouter, HTTPException, Query, Request, Response, status
+from fastapi.security import OAuth2PasswordRequestForm
+
+from session import get_async_session, SessionReleasingRoute
+from model import User, Item, Role
+import auth
+from hasher import HashingOverloadedError
+from env import Environment
+from schemas import (
+    UserResponseSchema,
+    UserPostSchema,
+    UserPutSchema,
+    ItemResponseSchema,
+    ItemListResponseSchema,
+    ItemIdsSchema,
+    MAX_BULK_IDS,
+    ItemPostSchema,
+    ItemPutSchema,
+    ItemPatchSchema,
+    ItemPatchResponseSchema,
+    RefreshTokenSchema,
+    LogoutSchema,
+    RevokeTokenSchema,
+    BatchRequestSchema,
+)
+from refresh_token import issue_refresh_token, rotate_refresh_token, revoke_refresh_token, revoke_refresh_tokens
+from revocation import revoke_token
+from pagination import decode_cursor, set_next_cursor
+from projection import ITEM_FIELDS, parse_fields, item_columns, to_dicts
+from export import export_response_async, check_format
+import item_import
+from item_import import insert_batch
+from role_service import get_roles_by_ids, RoleNotFoundError
+import batch
+
+from permission_service import PermissionType
+
+# routers.py と同じAPIを async def のハンドラと AsyncSession で実装したもの (db_async=True のときに利用する)
+# AsyncSessionでは属性アクセス時の遅延読み込みが使えないため、レスポンスに必要なリレーションは
+# selectinload で先に読み込んでおく
+#   https://docs.sqlalchemy.org/en/20/orm/extensions/asyncio.html#preventing-implicit-io-when-using-asyncsession
+
+router = APIRouter(route_class=SessionReleasingRoute)
+
+async def _get_roles(session: AsyncSession, role_ids: List[int]) -> List[Role]:
+    """idからロールを1回のSELECTで取得する。存在しないidがあれば、すべてのidを含めて404エラー"""
+    try:
+        return await session.run_sync(get_roles_by_ids, role_ids)
+    except RoleNotFoundError as e:
+        raise HTTPException(status_code=404, detail=f"Role is not found. (id={', '.join(map(str, e.missing))})")
+
+async def _get_user(session: AsyncSession, user_id: int) -> Optional[User]:
+    stmt = select(User).options(selectinload(User.roles)).where(User.id == user_id)
+    return (await session.execute(stmt)).scalars().first()
+
+# ユーザー作成
+@router.post("/users/", response_model=UserResponseSchema)
+async def create_user(
+    data: UserPostSchema,
+    session: AsyncSession = Depends(get_async_session),
+    _: auth.Principal = Depends(auth.get_current_user_async([PermissionType.USER_CREATE]))
+):
+    user = (await session.execute(select(User).where(User.username == data.username))).scalars().first()
+    if user:
+        raise HTTPException(status_code=400, detail=f"{data.username} is already exists.")
+
+    roles = await _get_roles(session, data.role_ids)
+    user = User(
+        username=data.username,
+        hashed_password=await auth.hash_async(data.password),
+        age=data.age,
+        roles=roles,
+    )
+    session.add(user)
+    await session.commit()
+    return user
+
+# ユーザー一覧
+@router.get("/users/", response_model=List[UserResponseSchema])
+async def read_users(
+    response: Response,
+    skip: int = 0,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    session: AsyncSession = Depends(get_async_session),
+    _: auth.Principal = Depends(auth.get_current_user_async([PermissionType.USER_READ]))
+):
+    stmt = select(User).options(selectinload(User.roles)).order_by(User.id)
+    if cursor is None:
+        stmt = stmt.offset(skip)
+    else:
+        (last_id,) = decode_cursor(cursor, 1)
+        stmt = stmt.where(User.id > last_id)
+    users = (await session.execute(stmt.limit(limit))).scalars().all()
+    set_next_cursor(response, users, limit, "id")
+    return users
+
+# ユーザーのエクスポート
+# 全ユーザーを NDJSON (format=ndjson) または CSV (format=csv) でストリーミングする
+@router.get("/users/export")
+async def export_users(
+    format: str = "ndjson",
+    session: AsyncSession = Depends(get_async_session),
+    _: auth.Principal = Depends(auth.get_current_user_async([PermissionType.USER_READ]))
+):
+    names = ["id", "username", "age", "created", "updated"]
+    stmt = select(*[getattr(User, name) for name in names]).order_by(User.id)
+    return export_response_async(session.bind, stmt, names, format, "users")
+
+# ユーザー取得
+@router.get("/users/{user_id}", response_model=UserResponseSchema)
+async def read_user(
+    user_id: int,
+    session: AsyncSession = Depends(get_async_session),
+    _: auth.Principal = Depends(auth.get_current_user_async([PermissionType.USER_READ]))
+):
+    user = await _get_user(session, user_id)
+    if user is None:
+        raise HTTPException(status_code=404, detail=f"User is not found. (id={user_id})")
+    return user
+
+# ユーザー更新
+@router.put("/users/{user_id}", response_model=UserResponseSchema)
+async def update_user(
+    user_id: int,
+    data: UserPutSchema,
+    session: AsyncSession = Depends(get_async_session),
+    _: auth.Principal = Depends(auth.get_current_user_async([PermissionType.USER_UPDATE]))
+):
+    user = await _get_user(session, user_id)
+    if user is None:
+        raise HTTPException(status_code=404, detail=f"User is not found. (id={user_id})")
+
+    roles = await _get_roles(session, data.role_ids)
+    user.hashed_password = await auth.hash_async(data.password)
+    user.age = data.age
+    user.roles = roles
+    user.token_version = user.token_version + 1
+    session.add(user)
+    await session.run_sync(revoke_refresh_tokens, user_id)
+    await session.commit()
+    auth.token_cache.invalidate_user(user_id)
+    auth.token_versions.set(user_id, user.token_version)
+    return user
+
+# ユーザー削除
+@router.delete("/users/{user_id}")
+async def delete_user(
+    user_id: int,
+    session: AsyncSession = Depends(get_async_session),
+    _: auth.Principal = Depends(auth.get_current_user_async([PermissionType.USER_DELETE]))
+):
+    user = await _get_user(session, user_id)
+    if user is None:
+        raise HTTPException(status_code=404, detail=f"User is not found. (id={user_id})")
+    # アイテム・ロールの割り当て・リフレッシュトークンはDBのカスケードで削除される
+    await session.delete(user)
+    await session.commit()
+    auth.token_cache.invalidate_user(user_id)
+    auth.token_versions.invalidate(user_id)
+    return {"user_id": user_id}
+
+# トークン取得API
+@router.post("/token")
+async def login_for_access_token(
+    session: AsyncSession = Depends(get_async_session),
+    form_data: OAuth2PasswordRequestForm = Depends()
+):
+    stmt = select(User).options(undefer(User.hashed_password)).where(User.username == form_data.username)
+    user = (await session.execute(stmt)).scalars().first()
+    if (user is None) or (not await auth.verify_password_async(form_data.password, user.hashed_password)):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Incorrect username or password",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    if auth.needs_rehash(user.hashed_password):
+        try:
+            user.hashed_password = await auth.hash_async(form_data.password)
+            await session.commit()
+        except HashingOverloadedError:
+            pass
+
+    refresh_token = await session.run_sync(issue_refresh_token, user.id)
+    await session.commit()
+    return await _token_response(session, user, refresh_token)
+
+# トークン更新API
+@router.post("/token/refresh")
+async def refresh_access_token(
+    data: RefreshTokenSchema,
+    session: AsyncSession = Depends(get_async_session),
+):
+    rotated = await session.run_sync(rotate_refresh_token, data.refresh_token)
+    user = None
+    if rotated is not None:
+        user_id, refresh_token = rotated
+        user = (await session.execute(select(User).where(User.id == user_id))).scalars().first()
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid refresh token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    await session.commit()
+    return await _token_response(session, user, refresh_token)
+
+# ログアウトAPI
+@router.post("/logout")
+async def logout(
+    data: Optional[LogoutSchema] = None,
+    session: AsyncSession = Depends(get_async_session),
+    current_user: auth.Principal = Depends(auth.get_current_user_async()),
+):
+    if current_user.jti is None:
+        raise HTTPException(status_code=400, detail="This token cannot be revoked.")
+    await session.run_sync(revoke_token, current_user.jti, datetime.fromtimestamp(current_user.expires))
+    if data is not None and data.refresh_token is not None:
+        await session.run_sync(revoke_refresh_token, current_user.id, data.refresh_token)
+    await session.commit()
+    auth.revocations.add(current_user.jti)
+    return {"jti": current_user.jti}
+
+# トークン失効API (管理者用)
+@router.post("/tokens/revoke")
+async def revoke(
+    data: RevokeTokenSchema,
+    session: AsyncSession = Depends(get_async_session),
+    _: auth.Principal = Depends(auth.get_current_user_async([PermissionType.USER_UPDATE]))
+):
+    env = Environment()
+    await session.run_sync(revoke_token, data.jti, datetime.now() + timedelta(minutes=env.token_expire_minutes))
+    await session.commit()
+    auth.revocations.add(data.jti)
+    return {"jti": data.jti}
+
+async def _token_response(session: AsyncSession, user: User, refresh_token: str) -> dict:
+    # ステートレスモードでは user.roles を読み込むため、run_sync の中でトークンを生成する
+    access_token = await session.run_sync(lambda _: auth.create_access_token(user))
+    return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
+
+
+# アイテムの新規作成
+@router.post("/items/", response_model=ItemResponseSchema)
+async def create(
+    data: ItemPostSchema,
+    session: AsyncSession = Depends(get_async_session),
+    current_user: auth.Principal = Depends(auth.get_current_user_async([PermissionType.ITEM_CREATE]))
+):
+    item = Item(user_id=current_user.id, title=data.title, content=data.content)
+    session.add(item)
+    await session.commit()
+    return item
+
+# アイテムの一括登録
+# NDJSON (format=ndjson) または CSV (format=csv, 1行目はヘッダ) のボディを受信しながら1行ずつ検証し、
+# import_batch_size 件ずつ複数行のINSERTで登録する (バッチごとにコミット)
+# 不正な行は登録せずに行番号とともにレスポンスで返し、残りの行の登録は続ける
+@router.post("/items/import")
+async def import_items(
+    request: Request,
+    format: str = "ndjson",
+    session: AsyncSession = Depends(get_async_session),
+    current_user: auth.Principal = Depends(auth.get_current_user_async([PermissionType.ITEM_CREATE]))
+):
+    check_format(format)
+    async def insert_rows(rows, result):
+        await session.run_sync(insert_batch, rows, result)
+    result = await item_import.import_items(request.stream(), format, current_user.id, insert_rows)
+    return result.to_dict()
+
+# アイテムの一覧
+@router.get("/items/", response_model=List[ItemListResponseSchema], response_model_exclude_unset=True)
+async def get_list(
+    response: Response,
+    skip: int = 0,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    summary: bool = False,
+    ids: Optional[List[int]] = Query(None, max_length=MAX_BULK_IDS),  # 指定した場合は、このidのアイテムだけを返す
+    session: AsyncSession = Depends(get_async_session),
+    current_user: auth.Principal = Depends(auth.get_current_user_async([PermissionType.ITEM_READ]))
+):
+    names = parse_fields(fields, summary)
+    if ids is not None:
+        return await _get_items(session, current_user.id, ids, names)
+    stmt = select(*item_columns(names)).where(Item.user_id == current_user.id).order_by(Item.user_id, Item.id)
+    if cursor is None:
+        stmt = stmt.offset(skip)
+    else:
+        user_id, last_id = decode_cursor(cursor, 2)
+        if user_id != current_user.id:
+            raise HTTPException(status_code=400, detail="Invalid cursor.")
+        stmt = stmt.where(Item.id > last_id)
+    rows = (await session.execute(stmt.limit(limit))).all()
+    set_next_cursor(response, rows, limit, "user_id", "id")
+    return to_dicts(rows, names)
+
+async def _get_items(session: AsyncSession, user_id: int, ids: List[int], names: List[str]) -> List[dict]:
+    stmt = select(*item_columns(names)) \
+        .where(and_(Item.user_id == user_id, Item.id.in_(ids))).order_by(Item.user_id, Item.id)
+    return to_dicts((await session.execute(stmt)).all(), names)
+
+# アイテムの複数取得
+@router.post("/items/bulk-get", response_model=List[ItemListResponseSchema], response_model_exclude_unset=True)
+async def bulk_get(
+    data: ItemIdsSchema,
+    fields: Optional[str] = None,
+    summary: bool = False,
+    session: AsyncSession = Depends(get_async_session),
+    current_user: auth.Principal = Depends(auth.get_current_user_async([PermissionType.ITEM_READ]))
+):
+    return await _get_items(session, current_user.id, data.ids, parse_fields(fields, summary))
+
+# アイテムの一括削除
+@router.post("/items/bulk-delete")
+async def bulk_delete(
+    data: ItemIdsSchema,
+    session: AsyncSession = Depends(get_async_session),
+    current_user: auth.Principal = Depends(auth.get_current_user_async([PermissionType.ITEM_DELETE]))
+):
+    stmt = sql_delete(Item).where(and_(Item.user_id == current_user.id, Item.id.in_(data.ids))) \
+        .execution_options(synchronize_session=False)
+    try:
+        result = await session.execute(stmt)
+        await session.commit()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+    return {"deleted": result.rowcount}
+
+# アイテムのエクスポート
+# ログインユーザーの全アイテムを NDJSON (format=ndjson) または CSV (format=csv) でストリーミングする
+# fields で出力する項目を指定できる (一覧APIと同じ)
+@router.get("/items/export")
+async def export_items(
+    format: str = "ndjson",
+    fields: Optional[str] = None,
+    session: AsyncSession = Depends(get_async_session),
+    current_user: auth.Principal = Depends(auth.get_current_user_async([PermissionType.ITEM_READ]))
+):
+    names = parse_fields(fields, False)
+    stmt = select(*[ITEM_FIELDS[name] for name in names]) \
+        .where(Item.user_id == current_user.id).order_by(Item.user_id, Item.id)
+    return export_response_async(session.bind, stmt, names, format, "items")
+
+# アイテムの取得
+@router.get("/items/{item_id}", response_model=ItemResponseSchema)
+async def get_item(
+    item_id: int,
+    session: AsyncSession = Depends(get_async_session),
+    _: auth.Principal = Depends(auth.get_current_user_async([PermissionType.ITEM_READ]))
+):
+    stmt = select(Item).options(undefer(Item.content)).where(Item.id == item_id)
+    item = (await session.execute(stmt)).scalars().first()
+    if item is None:
+        raise HTTPException(status_code=404, detail=f"Item is not found. (id={item_id})")
+    return item
+
+# アイテムの更新
+@router.put("/items/{item_id}", response_model=ItemResponseSchema)
+async def update(
+    item_id: int,
+    data: ItemPostSchema,
+    session: AsyncSession = Depends(get_async_session),
+    current_user: auth.Principal = Depends(auth.get_current_user_async([PermissionType.ITEM_UPDATE]))
+):
+    values = {"title": data.title, "content": data.content}
+    return await _update_item(session, item_id, current_user.id, values)
+
+# アイテムの部分更新
+@router.patch("/items/{item_id}", response_model=ItemPatchResponseSchema, response_model_exclude_unset=True)
+async def patch(
+    item_id: int,
+    data: ItemPatchSchema,
+    session: AsyncSession = Depends(get_async_session),
+    current_user: auth.Principal = Depends(auth.get_current_user_async([PermissionType.ITEM_UPDATE]))
+):
+    values = data.model_dump(exclude_unset=True)
+    if not values:
+        raise HTTPException(status_code=400, detail="No fields to update.")
+    return await _update_item(session, item_id, current_user.id, values)
+
+async def _update_item(session: AsyncSession, item_id: int, user_id: int, values: dict) -> dict:
+    stmt = sql_update(Item).where(and_(Item.id == item_id, Item.user_id == user_id)).values(**values) \
+        .execution_options(synchronize_session=False)
+    try:
+        result = await session.execute(stmt)
+        await session.commit()
+    except SQLAlchemyError:
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+    if result.rowcount == 0:
+        raise HTTPException(status_code=404, detail="item not found")
+    return {"id": item_id, **values}
+
+# アイテムの削除
+@router.delete("/items/{item_id}")
+async def delete(
+    item_id: int,
+    session: AsyncSession = Depends(get_async_session),
+    current_user: auth.Principal = Depends(auth.get_current_user_async([PermissionType.ITEM_DELETE]))
+):
+    stmt = sql_delete(Item).where(and_(Item.id == item_id, Item.user_id == current_user.id)) \
+        .execution_options(synchronize_session=False)
+    try:
+        result = await session.execute(stmt)
+        await session.commit()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+    if result.rowcount == 0:
+        raise HTTPException(status_code=404, detail="item not found")
+    return {"item_id": item_id}
+
+
+# バッチAPI
+# 複数のAPI呼び出し (method, path, body) を1回のHTTPリクエストで受け取り、HTTPを経由せずにルーターで順に処理する
+# 認証はバッチAPIで1回だけ行い、サブリクエストではそのPrincipalとバッチのコネクションを共有する
+# 各サブリクエストはセーブポイントで実行し、失敗したサブリクエストの変更はロールバックする
+# atomic=true の場合はすべてのサブリクエストを1つのトランザクションで実行し、失敗した時点で全体をロールバックする
+@router.post("/batch")
+async def batch_requests(
+    request: Request,
+    data: BatchRequestSchema,
+    session: AsyncSession = Depends(get_async_session),
+    current_user: auth.Principal = Depends(auth.get_current_user_async())
+):
+    batch.check_requests(data.requests)
+    return await batch.run(request, data.requests, current_user, data.atomic, batch.AsyncSavepointSessions(session))
@@ -1,23 +1,61 @@
-import bcrypt
+import os
 from fastapi.security import OAuth2PasswordBearer
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
+from sqlalchemy import select
 from sqlalchemy.orm import Session
-from jose import jwt, JWTError
-from session import get_session
-from model import User
+from sqlalchemy.ext.asyncio import AsyncSession
+from session import get_session, get_async_session
+from model import User, Role, UserRole, RoleType
 from env import Environment
-from typing import List, Callable
+from typing import Any, Dict, List, Callable, FrozenSet, Optional
+from datetime import datetime, timedelta, UTC
+import uuid
+from dataclasses import dataclass, replace
 from permission_service import PermissionType, PermissionService
+from token_cache import TokenCache, TokenVersionCache
+from hasher import PasswordHasher
+from revocation import RevocationList
+from token_codec import create_codec, InvalidTokenError
+import batch
+
+_env = Environment()
+_hash_workers = _env.hash_workers or os.cpu_count() or 1
+# bcryptの計算は専用のプロセスプールで実行する
+hasher = PasswordHasher(
+    workers=_hash_workers,
+    max_pending=_hash_workers + _env.hash_queue_size,
+    retry_after=_env.hash_retry_after,
+    rounds=_env.hash_rounds,
+)
 
 
 def hash(plain_password: str) -> str:
-    """パスワードをハッシュ化する"""
-    return bcrypt.hashpw(plain_password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+    """パスワードをハッシュ化する
+    プールが混雑している場合は HashingOverloadedError を送出する
+    """
+    return hasher.hash(plain_password)
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """plain_passwordが正しいパスワードかを検証する"""
-    return bcrypt.checkpw(plain_password.encode("utf-8"), hashed_password.encode("utf-8"))
+    """plain_passwordが正しいパスワードかを検証する
+    プールが混雑している場合は HashingOverloadedError を送出する
+    """
+    return hasher.verify(plain_password, hashed_password)
+
+
+async def hash_async(plain_password: str) -> str:
+    """hash の非同期版 (async def のハンドラから利用する)"""
+    return await hasher.hash_async(plain_password)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """verify_password の非同期版 (async def のハンドラから利用する)"""
+    return await hasher.verify_async(plain_password, hashed_password)
+
+
+def needs_rehash(hashed_password: str) -> bool:
+    """hashed_passwordのコストが設定値(hash_rounds)と異なるかを確認する"""
+    return hasher.needs_rehash(hashed_password)
 
 # OAuth2PasswordBearerのインスタンスをDependsで解決すると、
 # RequestのAuthorizationヘッダが `Bearer {token}` 形式であることを確認し、tokenをstrで返す
@@ -25,38 +63,193 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
 # もしAuthorizationヘッダがなかったり、 値の形式が異なっていた場合は、401ステータスエラー(UNAUTHORIZED)を返す。
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/v1/token")
 
-def get_current_user(permissions: List[PermissionType] = []) -> Callable:
-    def _get_current_user(
-        session: Session = Depends(get_session),
-        token: str = Depends(oauth2_scheme),
-    ) -> User:
-        """JWTの署名検証を行い、subに格納されているusernameからUserオブジェクトを取得する
-        引数のtokenには "/api/v1/token" でリターンした access_token が格納されている
-        """
-        credentials_exception = HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid authentication credentials",
-            headers={"WWW-Authenticate": "Bearer"}
-        )
-        env = Environment()
+
+@dataclass(frozen=True)
+class Principal:
+    """認証済みユーザーを表す軽量なオブジェクト
+    ORMのUserとは異なりセッションに紐づかないため、トークンキャッシュにそのまま保持できる
+    """
+    id: int
+    username: str
+    roles: FrozenSet[RoleType]
+    permission_mask: int   # 保持している権限のビットマスク (PermissionService.get_role_mask)
+    # ステートレストークンから生成した場合のトークンバージョン。DBから生成した場合はNone
+    token_version: Optional[int] = None
+    jti: Optional[str] = None       # トークンの識別子 (失効の判定に利用)
+    expires: Optional[int] = None   # トークンの有効期限 (UNIX時間)
+
+
+def load_principal(session: Session, username: str) -> Optional[Principal]:
+    """usersとrolesを結合した1回のクエリで、ユーザーとそのロール名を取得する"""
+    stmt = (
+        select(User.id, User.username, Role.name)
+        .outerjoin(UserRole, UserRole.user_id == User.id)
+        .outerjoin(Role, Role.id == UserRole.role_id)
+        .where(User.username == username)
+    )
+    rows = session.execute(stmt).all()
+    if not rows:
+        return None
+    roles = frozenset(role_name for _, _, role_name in rows if role_name is not None)
+    return Principal(
+        id=rows[0].id,
+        username=rows[0].username,
+        roles=roles,
+        permission_mask=PermissionService.get_role_mask(roles),
+    )
+
+
+def create_token_payload(user: User, expire: datetime) -> Dict[str, Any]:
+    """アクセストークンのペイロードを生成する
+    ステートレスモードの場合は、DBを参照せずに認可できるようユーザーID・権限・トークンバージョンを含める
+    """
+    payload = {
+        # JWT "sub" Claim : https://openid-foundation-japan.github.io/draft-ietf-oauth-json-web-token-11.ja.html#subDef
+        "sub": user.username,
+        "scopes": [],
+        "exp": expire,
+        # JWT "jti" Claim : ログアウト・失効の際にトークンを識別する
+        "jti": uuid.uuid4().hex,
+    }
+    if Environment().token_stateless:
+        roles = frozenset(role.name for role in user.roles)
+        payload["uid"] = user.id
+        payload["roles"] = [role.value for role in roles]
+        payload["perm"] = PermissionService.get_role_mask(roles)
+        payload["ver"] = user.token_version
+    return payload
+
+
+def create_access_token(user: User) -> str:
+    """アクセストークンを生成する"""
+    expire = datetime.now(UTC) + timedelta(minutes=Environment().token_expire_minutes)
+    return token_codec.encode(create_token_payload(user, expire))
+
+
+def principal_from_claims(payload: Dict[str, Any]) -> Principal:
+    """ステートレストークンのクレームからPrincipalを生成する (DBは参照しない)"""
+    return Principal(
+        id=payload["uid"],
+        username=payload["sub"],
+        roles=frozenset(RoleType(role) for role in payload["roles"]),
+        permission_mask=payload["perm"],
+        token_version=payload["ver"],
+    )
+
+
+# user_id -> users.token_version のキャッシュ
+# ユーザーの更新時は set 、削除時は invalidate で反映すること
+token_versions = TokenVersionCache(maxsize=_env.token_cache_size, ttl=_env.token_version_ttl)
+
+# 失効したトークン(jti)の一覧
+revocations = RevocationList(
+    bloom_bits=_env.revocation_bloom_bits,
+    bloom_hashes=_env.revocation_bloom_hashes,
+    recent_size=_env.revocation_recent_size,
+    reload_interval=_env.revocation_reload_interval,
+    reload_overlap=_env.revocation_reload_overlap,
+    rebuild_interval=_env.revocation_rebuild_interval,
+)
+
+def get_token_version(session: Session, user_id: int) -> Optional[int]:
+    """ユーザーの現在のトークンバージョンを取得する。キャッシュになければDBから取得する"""
+    version = token_versions.get(user_id)
+    if version is None:
+        version = session.query(User.token_version).filter(User.id == user_id).scalar()
+        if version is not None:
+            token_versions.set(user_id, version)
+    return version
+
+
+# アクセストークンのエンコード・デコードを行うオブジェクト (鍵は起動時に解析済み)
+token_codec = create_codec(_env)
+
+# 検証済みトークン -> Principal のキャッシュ
+# ユーザーの更新・削除時は invalidate_user で該当ユーザーのエントリを破棄すること
+token_cache = TokenCache(maxsize=_env.token_cache_size, ttl=_env.token_cache_ttl)
+
+def authenticate(session: Session, token: str, required_mask: int) -> Principal:
+    """トークンの署名検証を行い、subに格納されているusernameからPrincipalを取得する
+    引数のtokenには "/api/v1/token" でリターンした access_token が格納されている
+    要求された権限(required_mask)を持っていない場合は403エラーを送出する
+    """
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid authentication credentials",
+        headers={"WWW-Authenticate": "Bearer"}
+    )
+    principal = token_cache.get(token)
+    if principal is None:
         try:
-            payload = jwt.decode(token, env.token_secret_key, algorithms=[env.token_algorithm])
+            payload = token_codec.decode(token)
             username: str = payload["sub"]
             if username is None:
                 raise credentials_exception
-        except JWTError:
+        except InvalidTokenError:
             raise credentials_exception
 
-        user = session.query(User).filter(User.username == username).first()
-        if user is None:
+        if "perm" in payload:
+            principal = principal_from_claims(payload)
+        else:
+            principal = load_principal(session, username)
+            if principal is None:
+                raise credentials_exception
+        principal = replace(principal, jti=payload.get("jti"), expires=payload["exp"])
+        token_cache.set(token, principal.id, principal, payload["exp"])
+
+    # 失効したトークンでないことを確認する (通常はBloomフィルタで完結し、DBは参照しない)
+    if principal.jti is not None and revocations.is_revoked(session, principal.jti):
+        raise credentials_exception
+
+    # ステートレストークンは、トークンバージョンが最新であることを確認する (通常はメモリ上で完結する)
+    if principal.token_version is not None:
+        if principal.token_version != get_token_version(session, principal.id):
             raise credentials_exception
-    
-        # 要求された権限を持っているかを確認
-        if not PermissionService.has_permission(user, permissions):
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Permission denied.",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-        return user
+
+    check_permission(principal, required_mask)
+    return principal
+
+def check_permission(principal: Principal, required_mask: int) -> None:
+    """要求された権限を持っているかを確認し、持っていない場合は403エラーを送出する"""
+    if not PermissionService.has_mask(principal.permission_mask, required_mask):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Permission denied.",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+def _batch_principal(request: Request, required_mask: int) -> Optional[Principal]:
+    """バッチAPIのサブリクエストでは、バッチAPIで認証済みのPrincipalを再利用する"""
+    principal = request.scope.get(batch.PRINCIPAL_KEY)
+    if principal is not None:
+        check_permission(principal, required_mask)
+    return principal
+
+def get_current_user(permissions: List[PermissionType] = []) -> Callable:
+    # 要求する権限のビットマスクはルート定義時に1度だけ計算する
+    required_mask = PermissionService.permission_mask(permissions)
+
+    def _get_current_user(
+        request: Request,
+        session: Session = Depends(get_session),
+        token: str = Depends(oauth2_scheme),
+    ) -> Principal:
+        return _batch_principal(request, required_mask) or authenticate(session, token, required_mask)
+    return _get_current_user
+
+def get_current_user_async(permissions: List[PermissionType] = []) -> Callable:
+    """get_current_user の非同期版 (async_routers で利用する)"""
+    required_mask = PermissionService.permission_mask(permissions)
+
+    async def _get_current_user(
+        request: Request,
+        session: AsyncSession = Depends(get_async_session),
+        token: str = Depends(oauth2_scheme),
+    ) -> Principal:
+        principal = _batch_principal(request, required_mask)
+        if principal is not None:
+            return principal
+        # 同期版の処理を、AsyncSessionのドライバ上で実行する
+        # https://docs.sqlalchemy.org/en/20/orm/extensions/asyncio.html#sqlalchemy.ext.asyncio.AsyncSession.run_sync
+        return await session.run_sync(authenticate, token, required_mask)
     return _get_current_user
\ No newline at end of file
@@ -0,0 +1,176 @@
+import json
+import logging
+from typing import Any, Dict, List, Union
+
+import anyio
+from fastapi import HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from schemas import SubRequestSchema
+
+logger = logging.getLogger(__name__)
+
+# バッチAPIから呼び出すことのできるパスの接頭辞
+PATH_PREFIX = "/api/v1/"
+BATCH_PATH = "/api/v1/batch"
+
+# サブリクエストのスコープに設定するキー。
+# get_session / get_async_session はこのセッションを共有し、get_current_user はこのPrincipalを再利用する
+SESSION_KEY = "batch.session"
+PRINCIPAL_KEY = "batch.principal"
+
+# サブリクエスト用に引き継がないスコープのキー (ルーティングで設定される値)
+_ROUTING_KEYS = ("endpoint", "route", "path_params", "router")
+
+
+def _check(sub: SubRequestSchema) -> None:
+    path = sub.path.partition("?")[0]
+    if not path.startswith(PATH_PREFIX) or path.rstrip("/") == BATCH_PATH:
+        raise HTTPException(status_code=400, detail=f"Path is not allowed in batch. ({sub.path})")
+
+
+def check_requests(requests: List[SubRequestSchema]) -> None:
+    """実行前にすべてのサブリクエストのパスを確認する"""
+    for sub in requests:
+        _check(sub)
+
+
+async def dispatch(request: Request, sub: SubRequestSchema, state: Dict[str, Any]) -> Dict[str, Any]:
+    """サブリクエストを、HTTPを経由せずにアプリケーションのルーターで直接処理する
+
+    バッチリクエストのスコープ (例外ハンドラなど) と Authorization ヘッダを引き継ぎ、
+    state (共有するセッションと認証済みのPrincipal) をスコープに追加する。
+    """
+    path, _, query = sub.path.partition("?")
+    body = b"" if sub.body is None else json.dumps(sub.body).encode("utf-8")
+    headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode("ascii"))]
+    if "authorization" in request.headers:
+        headers.append((b"authorization", request.headers["authorization"].encode("latin-1")))
+    scope = {k: v for k, v in request.scope.items() if k not in _ROUTING_KEYS}
+    scope.update(
+        method=sub.method.upper(),
+        path=path,
+        raw_path=path.encode("utf-8"),
+        query_string=query.encode("utf-8"),
+        headers=headers,
+        **state,
+    )
+
+    # ボディを渡した後は、レスポンスの送信が完了するまで切断を通知しない。
+    # StreamingResponse は切断を検知すると送信を打ち切るため、すぐに切断を返すとボディが空になる
+    received = False
+    completed = anyio.Event()
+    async def receive():
+        nonlocal received
+        if received:
+            await completed.wait()
+            return {"type": "http.disconnect"}
+        received = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    response: Dict[str, Any] = {"status": 500, "headers": {}, "body": b""}
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = {k.decode("latin-1"): v.decode("latin-1") for k, v in message.get("headers", [])}
+        elif message["type"] == "http.response.body":
+            response["body"] += message.get("body", b"")
+            if not message.get("more_body", False):
+                completed.set()
+
+    try:
+        await request.app.router(scope, receive, send)
+    except Exception:
+        logger.exception("batch sub-request failed: %s %s", sub.method, sub.path)
+        return {"status": 500, "headers": {}, "body": {"detail": "Internal Server Error"}}
+    finally:
+        completed.set()
+
+    content = response["body"]
+    if response["headers"].get("content-type", "").startswith("application/json"):
+        content = json.loads(content) if content else None
+    else:
+        content = content.decode("utf-8", errors="replace")
+    return {"status": response["status"], "headers": response["headers"], "body": content}
+
+
+class SavepointSessions:
+    """サブリクエストごとに、バッチのセッションのトランザクションに結び付けたセッションを作る
+
+    サブリクエストでの commit / rollback はセーブポイントに対して行われ、
+    バッチのトランザクションを確定するかどうかは run が決める。
+      https://docs.sqlalchemy.org/en/20/orm/session_transaction.html#joining-a-session-into-an-external-transaction-such-as-for-test-suites
+    """
+
+    def __init__(self, session: Session):
+        self.session = session
+
+    async def open(self) -> Session:
+        connection = await run_in_threadpool(self.session.connection)
+        return Session(bind=connection, join_transaction_mode="create_savepoint")
+
+    async def close(self, shared: Session) -> None:
+        await run_in_threadpool(shared.close)
+
+    async def commit(self) -> None:
+        await run_in_threadpool(self.session.commit)
+
+    async def rollback(self) -> None:
+        await run_in_threadpool(self.session.rollback)
+
+
+class AsyncSavepointSessions:
+    """SavepointSessions の非同期版"""
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+
+    async def open(self) -> AsyncSession:
+        connection = await self.session.connection()
+        return AsyncSession(bind=connection, join_transaction_mode="create_savepoint", expire_on_commit=False)
+
+    async def close(self, shared: AsyncSession) -> None:
+        await shared.close()
+
+    async def commit(self) -> None:
+        await self.session.commit()
+
+    async def rollback(self) -> None:
+        await self.session.rollback()
+
+
+async def run(
+    request: Request,
+    requests: List[SubRequestSchema],
+    principal: Any,
+    atomic: bool,
+    sessions: Union[SavepointSessions, AsyncSavepointSessions],
+) -> Dict[str, Any]:
+    """サブリクエストを順に処理する
+
+    各サブリクエストは専用のセッション (セーブポイント) で実行するため、
+    失敗したサブリクエストのflush済みの変更や失敗した状態は、後続のサブリクエストに持ち越されない。
+    atomic でない場合はサブリクエストごとに、成功すればコミット、失敗すればロールバックする。
+    atomic の場合は失敗した時点で残りを実行せずに全体をロールバックし、すべて成功した場合のみコミットする。
+    """
+    results = []
+    for sub in requests:
+        shared = await sessions.open()
+        try:
+            result = await dispatch(request, sub, {SESSION_KEY: shared, PRINCIPAL_KEY: principal})
+        finally:
+            await sessions.close(shared)
+        results.append(result)
+        failed = result["status"] >= 400
+        if atomic and failed:
+            break
+        if not atomic:
+            await (sessions.rollback() if failed else sessions.commit())
+    if not atomic:
+        return {"results": results}
+
+    committed = len(results) == len(requests) and all(result["status"] < 400 for result in results)
+    await (sessions.commit() if committed else sessions.rollback())
+    return {"results": results, "committed": committed}
@@ -0,0 +1,125 @@
+import timeit
+import uuid
+from datetime import datetime, timedelta, UTC
+
+import click
+from jose import jwt
+
+from sqlalchemy import delete, insert, select
+
+from model import RoleType, User, Item
+from session import SessionLocal
+from permission_service import PermissionService, PermissionType
+from token_codec import JWTCodec, CompactCodec
+
+
+@click.group()
+def cli():
+    pass
+
+@cli.command()
+@click.option("-n", "--number", default=1000000, type=int)
+def permission(number):
+    """権限チェック1回あたりのコストを、集合演算とビットマスクで比較する"""
+    roles = frozenset([RoleType.LOCATION_ADMIN, RoleType.LOCATION_OPERATOR])
+    required = [PermissionType.ITEM_READ, PermissionType.ITEM_UPDATE]
+
+    # 変更前: リクエストごとにロールの権限集合の和を取り、要求された権限と比較する
+    # (ロールごとの権限集合は、定義を二重に持たないようビットマスクから作る)
+    role_permissions = {
+        role: PermissionService.get_mask_permissions(PermissionService.get_role_mask(frozenset([role])))
+        for role in RoleType
+    }
+    def check_set():
+        permissions = set()
+        for role in roles:
+            permissions = permissions | role_permissions.get(role, set())
+        required_permissions = set(required)
+        return len(required_permissions) == len(required_permissions & permissions)
+
+    # 変更後: 要求側のマスクはルート定義時に計算済み、ロール側のマスクはメモ化済み
+    required_mask = PermissionService.permission_mask(required)
+    def check_mask():
+        return PermissionService.has_mask(PermissionService.get_role_mask(roles), required_mask)
+
+    assert check_set() == check_mask()
+    for name, fn in [("set", check_set), ("mask", check_mask)]:
+        seconds = timeit.timeit(fn, number=number)
+        click.echo(f"{name:5s}: {seconds / number * 1e9:8.1f} ns/check")
+
+@cli.command()
+@click.option("-n", "--number", default=20000, type=int)
+def token_codec(number):
+    """トークンのエンコード・デコードのスループットをバックエンドごとに比較する"""
+    secret = "1234567890"
+    claims = {
+        "sub": "loc_operator",
+        "scopes": [],
+        "exp": datetime.now(UTC) + timedelta(minutes=480),
+        "jti": uuid.uuid4().hex,
+    }
+    keys = {"default": secret}
+    codecs = [
+        # 変更前: リクエストごとに生の秘密鍵文字列をpython-joseに渡す
+        ("jose(raw key)", lambda c: jwt.encode(c, secret, algorithm="HS256"),
+                          lambda t: jwt.decode(t, secret, algorithms=["HS256"])),
+        ("jwt", JWTCodec(keys, "default").encode, JWTCodec(keys, "default").decode),
+        ("compact", CompactCodec(keys, "default").encode, CompactCodec(keys, "default").decode),
+    ]
+    for name, encode, decode in codecs:
+        token = encode(claims)
+        assert decode(token)["sub"] == claims["sub"]
+        encode_seconds = timeit.timeit(lambda: encode(claims), number=number)
+        decode_seconds = timeit.timeit(lambda: decode(token), number=number)
+        click.echo(
+            f"{name:14s}: encode {number / encode_seconds:9.0f} ops/s, "
+            f"decode {number / decode_seconds:9.0f} ops/s, {len(token)} bytes"
+        )
+
+@cli.command()
+@click.option("-e", "--existing", default=100000, type=int, help="ユーザーが事前に持つアイテム数")
+@click.option("-n", "--number", default=100, type=int, help="計測で作成するアイテム数")
+def item_create(existing, number):
+    """大量のアイテムを持つユーザーに、アイテムを1件ずつ作成するコストを計測する (DB_* の接続先を利用する)"""
+    with SessionLocal() as session:
+        user = User(username=f"bench_{uuid.uuid4().hex[:8]}", hashed_password="-", age=0)
+        session.add(user)
+        session.commit()
+        user_id = user.id
+        try:
+            for start in range(0, existing, 10000):
+                session.execute(insert(Item), [
+                    {"user_id": user_id, "title": f"title{i}", "content": "x" * 1000}
+                    for i in range(start, min(start + 10000, existing))
+                ])
+            session.commit()
+
+            def create_with_list():
+                # 変更前: 通常のリストのリレーションへの追加は、ユーザーの全アイテムを読み込む
+                session.scalars(select(Item).where(Item.user_id == user_id)).all()
+                session.add(Item(user_id=user_id, title="title", content="content"))
+                session.commit()
+                session.expunge_all()
+
+            def create_with_write_only():
+                # 変更後: write_only のリレーションへの追加は INSERT のみ
+                session.get(User, user_id).items.add(Item(title="title", content="content"))
+                session.commit()
+
+            def create_with_user_id():
+                # routers.create と同じく user_id を指定して INSERT する
+                session.add(Item(user_id=user_id, title="title", content="content"))
+                session.commit()
+
+            for name, fn in [("list", create_with_list), ("write_only", create_with_write_only), ("user_id", create_with_user_id)]:
+                n = max(1, number // 10) if name == "list" else number
+                seconds = timeit.timeit(fn, number=n)
+                click.echo(f"{name:10s}: {seconds / n * 1000:8.2f} ms/item (existing={existing})")
+        finally:
+            session.rollback()
+            session.execute(delete(Item).where(Item.user_id == user_id))
+            session.execute(delete(User).where(User.id == user_id))
+            session.commit()
+
+if __name__ == "__main__":
+    cli()
@@ -9,7 +9,97 @@ class Environment(BaseSettings):
     db_port: str
     db_host: str
     db_name: str = "chapterx"
+    # Trueの場合、AsyncEngine(aiomysql)と async def のハンドラ(async_routers.py)でAPIを提供する
+    db_async: bool = False
+
+    # コネクションプール (ワーカープロセスごと)
+    #   db_pool_size    : 常に保持するコネクション数
+    #   db_max_overflow : pool_size を超えて一時的に作成できるコネクション数
+    #   db_pool_timeout : 空きコネクションを待つ最大秒数。超えるとエラーになる
+    #   db_pool_recycle : この秒数より古いコネクションは作り直す (MySQLの wait_timeout より短くする)
+    #   db_pool_pre_ping: 取得時に疎通確認を行い、切断済みのコネクションを作り直す
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30
+    db_pool_recycle: int = 3600
+    db_pool_pre_ping: bool = True
+
+    # 読み取り専用レプリカ ("host1:port1,host2" 形式。空の場合はすべてプライマリで処理する)
+    #   GET などの参照系リクエストはレプリカ、それ以外はプライマリ (db_host) で処理する
+    #   db_replica_sticky_seconds: 書き込みを行ったクライアントの参照をプライマリで処理する秒数。
+    #                              レプリカの遅延より長くしておくと、書き込んだ直後のデータを確実に読める
+    db_replica_hosts: str = ""
+    db_replica_sticky_seconds: float = 5.0
+
+    # リクエストごとのSQLの計測 (Server-Timing ヘッダとログに出力する)
+    #   sql_slow_query_ms       : この時間(ミリ秒)以上かかったSQLを、パラメータと呼び出し元とともに記録する
+    #   sql_n_plus_one_threshold: 同じ形のSQLが1リクエストでこの回数を超えて発行されたら、N+1の疑いとして警告する
+    #   sql_log_level           : 集計結果のログのレベル。INFOでリクエストごとの集計、WARNINGで遅いSQL・N+1の疑いのみ出力する。
+    #                             空文字の場合はアプリでログを設定しない (logging の設定に任せる)
+    sql_slow_query_ms: float = 100
+    sql_n_plus_one_threshold: int = 10
+    sql_log_level: str = "INFO"
+
+    # エクスポートAPIでサーバーサイドカーソルから一度に取り出す行数
+    export_chunk_size: int = 1000
+    # 一括登録APIで1回のINSERT(1トランザクション)にまとめる行数と、レスポンスで返すエラーの最大件数
+    import_batch_size: int = 1000
+    import_max_errors: int = 1000
+    # 一括登録APIで1回のINSERTにまとめる値の合計バイト数 (UTF-8)。件数が import_batch_size に満たなくても、
+    # これを超えた時点で登録する。受信中にメモリに保持する量と、MySQLの max_allowed_packet を超えないようにする
+    import_batch_max_bytes: int = 16 * 1024 * 1024
+    # 一括登録APIの1行(CSVは1レコード)の最大文字数。超えた行は保持せずに読み飛ばし、エラーとする
+    import_max_line_length: int = 16 * 1024 * 1024
 
     token_expire_minutes: int = 480
     token_secret_key: str = "1234567890"
-    token_algorithm: str = "HS256"
\ No newline at end of file
+    token_algorithm: str = "HS256"
+    # トークンの形式: "jwt" (python-jose) | "compact" (HMAC署名付きバイナリトークン)
+    token_codec: str = "jwt"
+    # token_secret_key の鍵ID。鍵をローテーションする場合は新しい鍵IDと鍵を設定し、
+    # 古い鍵を token_previous_keys ("kid1:secret1,kid2:secret2" 形式) に移す
+    token_key_id: str = "default"
+    token_previous_keys: str = ""
+    # リフレッシュトークンの有効期限。アクセストークン(token_expire_minutes)を短くしても、
+    # クライアントはパスワードを再送せずに /api/v1/token/refresh で更新できる
+    refresh_token_expire_minutes: int = 60 * 24 * 14
+
+    # 検証済みトークンのキャッシュ (ワーカープロセスごとに保持)
+    #   token_cache_size: キャッシュするトークンの最大数 (0でキャッシュ無効)
+    #   token_cache_ttl : キャッシュの有効秒数。manage.py など別プロセスでの変更はこの秒数以内に反映される
+    token_cache_size: int = 1024
+    token_cache_ttl: int = 60
+
+    # ステートレス認可モード
+    #   token_stateless  : Trueの場合、ユーザーID・権限・トークンバージョンをトークンに含めて発行する。
+    #                      これらを含むトークンはDBを参照せずに認可される
+    #   token_version_ttl: users.token_version をプロセス内にキャッシュする秒数。
+    #                      他のプロセスでのロール変更・削除はこの秒数以内に反映される
+    token_stateless: bool = False
+    token_version_ttl: int = 30
+
+    # トークン失効リスト (ワーカープロセスごとに保持)
+    #   revocation_bloom_bits     : Bloomフィルタのビット数
+    #   revocation_bloom_hashes   : Bloomフィルタのハッシュ関数の数
+    #   revocation_recent_size    : 正確に保持する最近の失効jtiの数
+    #   revocation_reload_interval: revoked_tokens テーブルから差分を読み込む間隔(秒)
+    #   revocation_reload_overlap : 差分の読み込みで前回の読み込み時刻からさかのぼる秒数。
+    #                               作成から遅れてコミットされた行やサーバー間の時刻のずれを吸収する
+    #   revocation_rebuild_interval: 有効期限内の行からBloomフィルタを作り直す間隔(秒)
+    revocation_bloom_bits: int = 1 << 20
+    revocation_bloom_hashes: int = 7
+    revocation_recent_size: int = 10000
+    revocation_reload_interval: float = 5.0
+    revocation_reload_overlap: float = 60.0
+    revocation_rebuild_interval: float = 3600.0
+
+    # パスワードハッシュ計算用のプロセスプール
+    #   hash_workers    : 子プロセス数 (0でCPUコア数)
+    #   hash_queue_size : 実行待ちにできる計算数。超えた場合は503を返す
+    #   hash_retry_after: 503レスポンスのRetry-Afterヘッダ(秒)
+    hash_workers: int = 0
+    hash_queue_size: int = 32
+    hash_retry_after: int = 1
+    # bcryptのコスト。 `python manage.py calibrate-hash` でこのマシンに合った値を計測できる
+    # 既存ユーザーのハッシュはログイン時に新しいコストで再計算される
+    hash_rounds: int = 12
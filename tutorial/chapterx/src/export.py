@@ -0,0 +1,117 @@
+import csv
+import io
+import json
+import time
+from datetime import datetime
+from contextlib import nullcontext
+from typing import AsyncIterator, Iterable, Iterator, List, Sequence, Union
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy import Select
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from env import Environment
+import query_stats
+
+_env = Environment()
+
+# エクスポートの形式とContent-Type
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+
+def _value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _encode(rows: Iterable[Sequence], names: List[str], format: str) -> str:
+    """行のまとまりを NDJSON または CSV の文字列に変換する"""
+    if format == "ndjson":
+        return "".join(
+            json.dumps({name: _value(v) for name, v in zip(names, row)}, ensure_ascii=False) + "\n"
+            for row in rows
+        )
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([_value(v) for v in row] for row in rows)
+    return buffer.getvalue()
+
+
+def _header(names: List[str], format: str) -> str:
+    if format == "csv":
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(names)
+        return buffer.getvalue()
+    return ""
+
+
+def _connect(bind):
+    """送信用のコネクション。バッチAPIのサブリクエストではセッションがバッチのコネクションに結び付いているため、
+    そのコネクション (バッチのトランザクション) で読み込み、closeはバッチAPIに任せる
+    """
+    if isinstance(bind, (Connection, AsyncConnection)):
+        return nullcontext(bind)
+    return bind.connect()
+
+
+def _stream(engine: Union[Engine, Connection], stmt: Select, names: List[str], format: str, name: str) -> Iterator[str]:
+    # サーバーサイドカーソル (PyMySQLの SSCursor) で結果をバッファせずに受け取り、
+    # export_chunk_size 行ずつ変換して送り出す。行数によらずワーカーのメモリ使用量は一定になる
+    #   https://docs.sqlalchemy.org/en/20/core/connections.html#using-server-side-cursors-a-k-a-stream-results
+    yield _header(names, format)
+    # 送信はミドルウェアが Server-Timing を設定しログを出力した後に行われるため、
+    # ここで発行するSQLは別に集計し、送信の完了時にログに出力する
+    stats = query_stats.start()
+    started = time.perf_counter()
+    count = 0
+    with _connect(engine) as conn:
+        result = conn.execution_options(yield_per=_env.export_chunk_size).execute(stmt)
+        for rows in result.partitions():
+            count += len(rows)
+            yield _encode(rows, names, format)
+    query_stats.log_stream(stats, name, count, (time.perf_counter() - started) * 1000)
+
+
+async def _stream_async(engine: Union[AsyncEngine, AsyncConnection], stmt: Select, names: List[str], format: str, name: str) -> AsyncIterator[str]:
+    yield _header(names, format)
+    stats = query_stats.start()
+    started = time.perf_counter()
+    count = 0
+    async with _connect(engine) as conn:
+        result = await conn.stream(stmt, execution_options={"yield_per": _env.export_chunk_size})
+        async for rows in result.partitions():
+            count += len(rows)
+            yield _encode(rows, names, format)
+    query_stats.log_stream(stats, name, count, (time.perf_counter() - started) * 1000)
+
+
+def _response(content, format: str, filename: str) -> StreamingResponse:
+    return StreamingResponse(
+        content,
+        media_type=FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{format}"'},
+    )
+
+
+def check_format(format: str) -> None:
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format. ({format})")
+
+
+def export_response(engine: Union[Engine, Connection], stmt: Select, names: List[str], format: str, filename: str) -> StreamingResponse:
+    """stmt の結果をストリーミングで返すレスポンス
+
+    レスポンスの送信はリクエストのセッションのclose後に行われるため、
+    セッションのエンジンから送信用のコネクションを別に取得する。
+    """
+    check_format(format)
+    return _response(_stream(engine, stmt, names, format, filename), format, filename)
+
+
+def export_response_async(engine: Union[AsyncEngine, AsyncConnection], stmt: Select, names: List[str], format: str, filename: str) -> StreamingResponse:
+    """export_response の非同期版"""
+    check_format(format)
+    return _response(_stream_async(engine, stmt, names, format, filename), format, filename)
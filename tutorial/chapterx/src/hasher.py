@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import multiprocessing
+import statistics
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import bcrypt
+
+logger = logging.getLogger(__name__)
+
+
+class HashingOverloadedError(Exception):
+    """ハッシュ計算の待ち行列が満杯のときに送出される例外"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Password hashing is overloaded.")
+        self.retry_after = retry_after
+
+
+# ProcessPoolExecutorの子プロセスで実行されるため、picklableなトップレベル関数として定義する
+def _hashpw(plain_password: bytes, rounds: int) -> bytes:
+    return bcrypt.hashpw(plain_password, bcrypt.gensalt(rounds))
+
+
+def _checkpw(plain_password: bytes, hashed_password: bytes) -> bool:
+    return bcrypt.checkpw(plain_password, hashed_password)
+
+
+def get_rounds(hashed_password: str) -> int:
+    """bcryptのハッシュ値 ("$2b$12$...") からコスト(ラウンド数)を取り出す"""
+    return int(hashed_password.split("$")[2])
+
+
+def calibrate_rounds(
+    target_ms: float,
+    min_rounds: int = 4,
+    max_rounds: int = 16,
+    samples: int = 3,
+) -> Tuple[int, List[Tuple[int, float]]]:
+    """このマシンでbcryptの検証時間を計測し、target_ms 以内に収まる最大のコストを返す
+
+    戻り値は (推奨コスト, [(コスト, 検証時間の中央値ms), ...])
+    """
+    plain_password = b"calibration-password"
+    timings = []
+    best = min_rounds
+    for rounds in range(min_rounds, max_rounds + 1):
+        hashed_password = bcrypt.hashpw(plain_password, bcrypt.gensalt(rounds))
+        elapsed = []
+        for _ in range(samples):
+            start = time.perf_counter()
+            bcrypt.checkpw(plain_password, hashed_password)
+            elapsed.append((time.perf_counter() - start) * 1000)
+        median_ms = statistics.median(elapsed)
+        timings.append((rounds, median_ms))
+        if median_ms > target_ms:
+            break
+        best = rounds
+    return best, timings
+
+
+class PasswordHasher:
+    """bcryptの計算を専用のプロセスプールで実行するクラス
+
+    同時に受け付ける計算数を max_pending (実行中 + 待ち行列) に制限し、
+    上限を超えた場合は待たずに HashingOverloadedError を送出する。
+    これによりログインが集中してもリクエスト処理用のスレッドを使い切らない。
+    """
+
+    def __init__(self, workers: int, max_pending: int, retry_after: int = 1, rounds: int = 12):
+        self.workers = workers
+        self.rounds = rounds
+        self.max_pending = max_pending
+        self.retry_after = retry_after
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        # 統計情報
+        self._in_flight = 0
+        self._completed = 0
+        self._rejected = 0
+        self._total_seconds = 0.0
+        self._max_seconds = 0.0
+
+    def hash(self, plain_password: str) -> str:
+        return self._run(_hashpw, plain_password.encode("utf-8"), self.rounds).decode("utf-8")
+
+    def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return self._run(_checkpw, plain_password.encode("utf-8"), hashed_password.encode("utf-8"))
+
+    async def hash_async(self, plain_password: str) -> str:
+        hashed_password = await self._run_async(_hashpw, plain_password.encode("utf-8"), self.rounds)
+        return hashed_password.decode("utf-8")
+
+    async def verify_async(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run_async(_checkpw, plain_password.encode("utf-8"), hashed_password.encode("utf-8"))
+
+    def needs_rehash(self, hashed_password: str) -> bool:
+        """ハッシュ値のコストが設定値と異なる場合にTrueを返す"""
+        return get_rounds(hashed_password) != self.rounds
+
+    def stats(self) -> Dict[str, Any]:
+        """プールの状態と計算時間の統計を返す"""
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "rounds": self.rounds,
+                "max_pending": self.max_pending,
+                "in_flight": self._in_flight,
+                "queued": max(0, self._in_flight - self.workers),
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "avg_ms": (self._total_seconds / self._completed * 1000) if self._completed else 0.0,
+                "max_ms": self._max_seconds * 1000,
+            }
+
+    def _run(self, fn: Callable, *args: Any) -> Any:
+        start = self._acquire()
+        try:
+            executor = self._get_executor()
+            try:
+                return executor.submit(fn, *args).result()
+            except BrokenProcessPool:
+                # 子プロセスが異常終了した場合は、プールを作り直して1回だけ再試行する
+                return self._replace_executor(executor).submit(fn, *args).result()
+        finally:
+            self._release(start)
+
+    async def _run_async(self, fn: Callable, *args: Any) -> Any:
+        # イベントループをブロックしないよう、プロセスプールの完了をawaitで待つ
+        start = self._acquire()
+        try:
+            executor = self._get_executor()
+            try:
+                return await asyncio.wrap_future(executor.submit(fn, *args))
+            except BrokenProcessPool:
+                return await asyncio.wrap_future(self._replace_executor(executor).submit(fn, *args))
+        finally:
+            self._release(start)
+
+    def _acquire(self) -> float:
+        """計算の枠を確保する。空きがなければ HashingOverloadedError を送出する"""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            logger.warning("password hashing rejected: %s", self.stats())
+            raise HashingOverloadedError(self.retry_after)
+
+        with self._lock:
+            self._in_flight += 1
+        return time.perf_counter()
+
+    def _release(self, start: float) -> None:
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._in_flight -= 1
+            self._completed += 1
+            self._total_seconds += elapsed
+            self._max_seconds = max(self._max_seconds, elapsed)
+        self._slots.release()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # 子プロセスは最初に利用されたときに起動する。
+        # リクエスト処理中のスレッドから起動するため、ロックを保持したままの状態を複製する fork ではなく
+        # spawn で新しいインタプリタとして起動する
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._executor
+
+    def _replace_executor(self, broken: ProcessPoolExecutor) -> ProcessPoolExecutor:
+        """壊れたプールを破棄して作り直す。他のスレッドが作り直し済みであればそれを返す"""
+        with self._lock:
+            if self._executor is broken:
+                logger.warning("password hashing pool is broken, recreating it")
+                self._executor = None
+        broken.shutdown(wait=False)
+        return self._get_executor()
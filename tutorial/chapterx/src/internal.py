@@ -0,0 +1,21 @@
+from fastapi import APIRouter, Depends
+
+import auth
+from permission_service import PermissionType
+from session import engine, async_engine, replica_engines, async_replica_engines
+from pool_stats import get_pool_stats
+
+# 運用向けの内部API (外部に公開しないこと)
+# SQLの形や呼び出し元などを含むため、公開されるアプリに含める場合も SYSTEM_READ 権限を必須とする
+router = APIRouter(dependencies=[Depends(auth.get_current_user([PermissionType.SYSTEM_READ]))])
+
+# 統計情報
+@router.get("/stats")
+def get_stats():
+    return {
+        "hashing": auth.hasher.stats(),
+        "db_pool": get_pool_stats(engine),
+        "async_db_pool": get_pool_stats(async_engine.sync_engine),
+        "replica_db_pools": [get_pool_stats(e) for e in replica_engines],
+        "async_replica_db_pools": [get_pool_stats(e.sync_engine) for e in async_replica_engines],
+    }
@@ -0,0 +1,189 @@
+import codecs
+import csv
+import json
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pydantic import ValidationError
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+from env import Environment
+from model import Item
+from schemas import ItemPostSchema
+
+_env = Environment()
+
+# items.title の最大長
+_TITLE_LENGTH = Item.__table__.c.title.type.length
+
+# (行番号, 行の値) のリスト
+Rows = List[Tuple[int, Dict[str, Any]]]
+
+
+class ImportResult:
+    """インポートの結果。エラーは行番号とともに max_errors 件まで保持する"""
+
+    def __init__(self, max_errors: int):
+        self.max_errors = max_errors
+        self.inserted = 0
+        self.error_count = 0
+        self.errors: List[Dict[str, Any]] = []
+
+    def add_error(self, line: int, detail: Any) -> None:
+        self.error_count += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({"line": line, "detail": detail})
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"inserted": self.inserted, "error_count": self.error_count, "errors": self.errors}
+
+
+async def _lines(chunks: AsyncIterator[bytes], max_length: int) -> AsyncIterator[Tuple[int, Optional[str]]]:
+    """受信したボディを、全体をメモリに載せずに1行ずつ取り出す
+
+    受信したチャンクだけを分割し、行の途中までの部分はリストに溜める。
+    max_length を超えた行はそれ以上保持せず、行の終わりで None を返す。
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending: List[str] = []
+    pending_length = 0
+    too_long = False
+    number = 0
+
+    async def decoded():
+        async for chunk in chunks:
+            yield decoder.decode(chunk)
+        yield decoder.decode(b"", final=True)
+
+    async for text in decoded():
+        *lines, tail = text.split("\n")
+        for line in lines:
+            number += 1
+            if too_long or pending_length + len(line) > max_length:
+                yield number, None
+            else:
+                pending.append(line)
+                yield number, "".join(pending)
+            pending, pending_length, too_long = [], 0, False
+        if too_long:
+            continue
+        pending_length += len(tail)
+        if pending_length > max_length:
+            pending, too_long = [], True
+        elif tail:
+            pending.append(tail)
+    if pending or too_long:
+        yield number + 1, None if too_long else "".join(pending)
+
+
+async def _records(chunks: AsyncIterator[bytes], format: str) -> AsyncIterator[Tuple[int, Optional[Dict], Optional[str]]]:
+    """NDJSON / CSV の各行を (行番号, 値, 解析エラー) として返す。CSVは1行目をヘッダとする"""
+    max_length = _env.import_max_line_length
+    too_long = f"Line exceeds {max_length} characters."
+    header = None
+    pending: List[str] = []
+    pending_length = 0
+    pending_quotes = 0
+    pending_line = 0
+    async for number, line in _lines(chunks, max_length):
+        if format == "ndjson":
+            if line is None:
+                yield number, None, too_long
+                continue
+            if not line.strip():
+                continue
+            try:
+                value = json.loads(line)
+            except ValueError as e:
+                yield number, None, f"Invalid JSON: {e}"
+                continue
+            if not isinstance(value, dict):
+                yield number, None, "Each line must be a JSON object."
+                continue
+            yield number, value, None
+            continue
+
+        # CSV: 引用符で囲まれた値に改行が含まれる場合は、引用符が閉じるまで行を連結する
+        pending_line = pending_line or number
+        if line is None or pending_length + len(line) > max_length:
+            # 連結中のレコードは破棄し、次の行から読み直す
+            yield pending_line, None, too_long
+            pending, pending_length, pending_quotes, pending_line = [], 0, 0, 0
+            continue
+        pending.append(line)
+        pending_length += len(line) + 1
+        pending_quotes += line.count('"')
+        if pending_quotes % 2 == 1:
+            continue
+        text, start = "\n".join(pending).rstrip("\r"), pending_line
+        pending, pending_length, pending_quotes, pending_line = [], 0, 0, 0
+        if not text:
+            continue
+        values = next(csv.reader([text]))
+        if header is None:
+            header = values
+            continue
+        if len(values) != len(header):
+            yield start, None, f"Expected {len(header)} columns, got {len(values)}."
+            continue
+        yield start, dict(zip(header, values)), None
+    if pending:
+        yield pending_line, None, "Unterminated quoted value."
+
+
+def insert_batch(session: Session, rows: Rows, result: ImportResult) -> None:
+    """rows を複数行のINSERTでまとめて登録し、1回だけコミットする
+
+    失敗した場合はセーブポイントまで戻し、同じトランザクションの中で1行ずつ (行ごとのセーブポイントで)
+    登録し直してエラーの行を特定する。エラーの行があってもバッチのトランザクションは1つのまま。
+    """
+    try:
+        with session.begin_nested():
+            session.execute(insert(Item), [values for _, values in rows])
+        result.inserted += len(rows)
+    except Exception:
+        for number, values in rows:
+            try:
+                with session.begin_nested():
+                    session.execute(insert(Item), [values])
+                result.inserted += 1
+            except Exception as e:
+                result.add_error(number, str(getattr(e, "orig", e)))
+    session.commit()
+
+
+async def import_items(
+    chunks: AsyncIterator[bytes],
+    format: str,
+    user_id: int,
+    insert_rows: Callable[[Rows, ImportResult], Awaitable[None]],
+) -> ImportResult:
+    """ストリーミングで受信したアイテムを検証し、import_batch_size 件ずつ insert_rows に渡す
+    値の合計が import_batch_max_bytes を超えた場合は、件数に達していなくても渡す
+
+    不正な行はエラーとして記録し、残りの行の登録は続ける。
+    """
+    result = ImportResult(_env.import_max_errors)
+    batch: Rows = []
+    batch_bytes = 0
+    async for number, value, error in _records(chunks, format):
+        if error is not None:
+            result.add_error(number, error)
+            continue
+        try:
+            item = ItemPostSchema.model_validate(value)
+        except ValidationError as e:
+            result.add_error(number, [{"loc": err["loc"], "msg": err["msg"]} for err in e.errors()])
+            continue
+        # DBで失敗する値は登録前にエラーにし、バッチのINSERTを1行ずつに戻さないようにする
+        if len(item.title) > _TITLE_LENGTH:
+            result.add_error(number, f"title must be at most {_TITLE_LENGTH} characters.")
+            continue
+        batch.append((number, {"user_id": user_id, "title": item.title, "content": item.content}))
+        batch_bytes += len(item.title.encode("utf-8")) + len(item.content.encode("utf-8"))
+        if len(batch) >= _env.import_batch_size or batch_bytes >= _env.import_batch_max_bytes:
+            await insert_rows(batch, result)
+            batch, batch_bytes = [], 0
+    if batch:
+        await insert_rows(batch, result)
+    return result
@@ -1,19 +1,52 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from routers import router
+from async_routers import router as async_router
+from internal import router as internal_router
+from env import Environment
+from hasher import HashingOverloadedError
+import query_stats
+from pagination import NEXT_CURSOR_HEADER
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 
 app = FastAPI()
 
+# SQLの集計結果のログ (query_stats) を出力する
+query_stats.configure_logging(Environment().sql_log_level)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],     # クロスオリジンリクエストを許可するオリジンのリスト。 "*" はすべて許可。
     allow_credentials=True,  # Cookieがクロスオリジンリクエストに対してサポートされるべきかどうか。
     allow_methods=["*"],     # クロスオリジンリクエストで許可されるHTTPメソッドのリスト。 "*" はすべて許可。
     allow_headers=["*"],     # クロスオリジンリクエストで許可されるHTTPヘッダのリスト。 "*" はすべて許可。
+    expose_headers=[NEXT_CURSOR_HEADER],  # ブラウザのスクリプトから参照できるレスポンスヘッダのリスト。
 )
 
-app.include_router(router, prefix="/api/v1")
+# リクエストごとに発行したSQLの件数と時間を集計し、Server-Timing ヘッダとログに出力する
+# StreamingResponse (エクスポートAPI) の送信中に発行するSQLはここでは集計されないため、
+# 送信の完了時に別のログ (query_stats.log_stream) として出力する
+@app.middleware("http")
+async def record_query_stats(request: Request, call_next):
+    stats = query_stats.start()
+    response = await call_next(request)
+    response.headers["Server-Timing"] = stats.server_timing()
+    query_stats.log(stats, request.method, request.url.path, response.status_code)
+    return response
+
+# db_async=True の場合は AsyncEngine と async def のハンドラでAPIを提供する
+app.include_router(async_router if Environment().db_async else router, prefix="/api/v1")
+app.include_router(internal_router, prefix="/internal")
+
+# パスワードハッシュ計算のプールが混雑している場合は、待たずに503を返す
+@app.exception_handler(HashingOverloadedError)
+def hashing_overloaded_handler(request: Request, exc: HashingOverloadedError):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Server is busy. Please retry later."},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
 
 # html=True : パスの末尾が "/" の時に自動的に index.html をロードする
 # name="static" : FastAPIが内部的に利用する名前を付けます
@@ -1,7 +1,10 @@
 import click
 
-from model import User, Role, RoleType
+from model import User, RoleType
 from session import SessionLocal
+from hasher import calibrate_rounds
+from role_service import get_roles_by_names
+from revocation import purge_expired
 import auth
 
 
@@ -22,15 +25,13 @@ def create_user(user_name, age, role, password):
             raise Exception(f"{user_name} is already exists.")
 
         # roleの存在確認
-        role = session.query(Role).filter(Role.name == role).first()
-        if role is None:
-            raise Exception(f"{role} Role is not found.")
+        roles = get_roles_by_names(session, [role])
 
         user = User(
             username=user_name,
             hashed_password=auth.hash(password),
             age=age,
-            roles=[role],
+            roles=roles,
         )
         session.add(user)
         session.commit()
@@ -48,5 +49,22 @@ def delete_user(user_name):
         session.delete(user)
         session.commit()
 
+@cli.command()
+@click.option("-t", "--target-ms", default=250.0, type=float, help="パスワード検証1回あたりの目標時間(ms)")
+def calibrate_hash(target_ms):
+    """このマシンでbcryptを計測し、目標時間に収まるコストを表示する"""
+    rounds, timings = calibrate_rounds(target_ms)
+    for r, ms in timings:
+        click.echo(f"rounds={r:2d}: {ms:8.1f} ms")
+    click.echo(f"recommended: HASH_ROUNDS={rounds}")
+
+@cli.command()
+def purge_revoked_tokens():
+    """有効期限を過ぎた失効トークンを revoked_tokens テーブルから削除する (cronなどで定期的に実行する)"""
+    with SessionLocal() as session:
+        count = purge_expired(session)
+        session.commit()
+    click.echo(f"purged: {count}")
+
 if __name__ == "__main__":
     cli()
@@ -1,7 +1,7 @@
 import enum
 from datetime import datetime
-from sqlalchemy import Boolean, Column, Integer, String, UniqueConstraint, text
-from sqlalchemy.orm import relationship
+from sqlalchemy import Boolean, Column, Index, Integer, String, UniqueConstraint, text
+from sqlalchemy.orm import deferred, relationship
 from sqlalchemy.sql.sqltypes import DateTime, Enum
 from sqlalchemy.sql.schema import ForeignKey
 from sqlalchemy.dialects.mysql import MEDIUMTEXT
@@ -20,8 +20,11 @@ class User(Base):
     id = Column(Integer, primary_key=True, index=True)
     # collation(照合順序): https://dev.mysql.com/doc/refman/8.0/ja/charset-mysql.html
     username = Column(String(255, collation="utf8mb4_bin"), unique=True, index=True, nullable=False)
-    hashed_password = Column(String(255), nullable=False)
+    # 参照するのはログイン時だけのため、通常の読み込みには含めない (必要な場合は undefer する)
+    hashed_password = deferred(Column(String(255), nullable=False))
     age = Column(Integer, nullable=True)
+    # トークンバージョン: インクリメントすると、発行済みのステートレストークンが失効する
+    token_version = Column(Integer, default=0, server_default=text("0"), nullable=False)
     created = Column(DateTime, default=datetime.now, nullable=False)
     updated = Column(DateTime, default=datetime.now, onupdate=datetime.now, nullable=False)
 
@@ -31,29 +34,45 @@ class User(Base):
         "Item",           # リレーションモデル名
         back_populates="user",      # リレーション先の変数名
         # カスケード: https://docs.sqlalchemy.org/en/14/orm/cascades.html
-        #   "all, delete-orphan": userを削除したときに、関連する items を削除する
-        #   "save-update": userを削除したときに、関連する items のuser_idをNullにする (default)
+        #   "all, delete-orphan": user.items から外したアイテムを削除する
+        #   userの削除時は、ORMはアイテムを読み込まず削除もしない。
+        #   items.user_id の ON DELETE CASCADE によりDB側で削除される (passive_deletes、マイグレーション c41f0b6a8e73)
         cascade="all, delete-orphan",
+        # write_only: user.items にアクセスしてもアイテムを読み込まない。
+        #   追加は user.items.add(item)、取得は session.scalars(user.items.select()) で行う
+        #   https://docs.sqlalchemy.org/en/20/orm/large_collections.html#write-only-relationships
+        #   (通常のリストの場合、1件追加するだけでもユーザーの全アイテムを読み込んでしまう)
+        lazy="write_only",
+        # userの削除時にアイテムを読み込まず、DBのカスケードに任せる
+        passive_deletes=True,
     )
 
     # リレーション (many to many)
     #   多対多のリレーション: https://docs.sqlalchemy.org/en/14/orm/basic_relationships.html#many-to-many
-    roles = relationship("Role", secondary="user_roles", back_populates="users")
+    #   passive_deletes: userの削除時に user_roles を読み込まず、DBのカスケード (ON DELETE CASCADE) で削除する
+    roles = relationship("Role", secondary="user_roles", back_populates="users", passive_deletes=True)
 
     def __repr__(self):
-        return f"<User(id={self.id}, username={self.username},items={self.items}, roles={self.roles})>"
+        return f"<User(id={self.id}, username={self.username}, roles={self.roles})>"
 
 
 class Item(Base):
     """items テーブルの定義
     """
     __tablename__ = "items"
-    __table_args__ = {'mysql_engine':'InnoDB', 'mysql_charset':'utf8mb4','mysql_collate':'utf8mb4_bin'}
+    __table_args__ = (
+        # ユーザーごとのアイテム一覧を id 順に範囲検索するための複合インデックス (キーセットページネーション)
+        Index("idx_items_userid_id", "user_id", "id"),
+        {'mysql_engine':'InnoDB', 'mysql_charset':'utf8mb4','mysql_collate':'utf8mb4_bin'}
+    )
     
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    # ユーザー削除時はDB側で削除する
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     title = Column(String(255), nullable=False)
-    content = Column(MEDIUMTEXT)
+    # 最大16MBになるため、一覧などでは読み込まない (必要な場合は undefer する)
+    #   https://docs.sqlalchemy.org/en/20/orm/queryguide/columns.html#deferred-column-loading
+    content = deferred(Column(MEDIUMTEXT))
     created = Column(DateTime, default=datetime.now, nullable=False)
     updated = Column(DateTime, default=datetime.now, onupdate=datetime.now, nullable=False)
 
@@ -72,11 +91,51 @@ class UserRole(Base):
     )
 
     id = Column(Integer, primary_key=True, index=True, nullable=False)
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    # ユーザー削除時はDB側で削除する
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     role_id = Column(Integer, ForeignKey("roles.id"), nullable=False)
     created = Column(DateTime, default=datetime.now, nullable=False)
     updated = Column(DateTime, default=datetime.now, onupdate=datetime.now, nullable=False)
 
+class RefreshToken(Base):
+    """refresh_tokens テーブルの定義
+    リフレッシュトークンそのものではなく、SHA-256のハッシュ値を保存する
+    """
+    __tablename__ = "refresh_tokens"
+    __table_args__ = {'mysql_engine':'InnoDB', 'mysql_charset':'utf8mb4','mysql_collate':'utf8mb4_bin'}
+
+    id = Column(Integer, primary_key=True)
+    # ユーザー削除時はDB側で削除する
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), index=True, nullable=False)
+    token_hash = Column(String(64), unique=True, nullable=False)
+    expires = Column(DateTime, nullable=False)
+    created = Column(DateTime, default=datetime.now, nullable=False)
+    updated = Column(DateTime, default=datetime.now, onupdate=datetime.now, nullable=False)
+
+    def __repr__(self):
+        return f"""<RefreshToken(id={self.id}, user_id={self.user_id}, expires={self.expires})>"""
+
+class RevokedToken(Base):
+    """revoked_tokens テーブルの定義
+    ログアウト・管理者による失効で無効になったアクセストークンのjtiを保持する
+    各ワーカーは created の範囲で差分を読み込み、定期的に有効期限内の行からBloomフィルタを作り直す
+    """
+    __tablename__ = "revoked_tokens"
+    __table_args__ = (
+        Index("idx_revoked_tokens_created", "created"),
+        Index("idx_revoked_tokens_expires", "expires"),
+        {'mysql_engine':'InnoDB', 'mysql_charset':'utf8mb4','mysql_collate':'utf8mb4_bin'},
+    )
+
+    id = Column(Integer, primary_key=True)
+    jti = Column(String(64), unique=True, nullable=False)
+    expires = Column(DateTime, nullable=False)  # トークンの有効期限。これを過ぎた行は `manage.py purge-revoked-tokens` で削除する
+    created = Column(DateTime, default=datetime.now, nullable=False)
+    updated = Column(DateTime, default=datetime.now, onupdate=datetime.now, nullable=False)
+
+    def __repr__(self):
+        return f"""<RevokedToken(id={self.id}, jti={self.jti}, expires={self.expires})>"""
+
 class RoleType(str, enum.Enum):
     SYSTEM_ADMIN      = "SYSTEM_ADMIN"
     LOCATION_ADMIN    = "LOCATION_ADMIN"
@@ -0,0 +1,37 @@
+import base64
+import json
+from typing import Any, Optional, Sequence, Tuple
+
+from fastapi import HTTPException, Response
+
+# 次のページのカーソルを返すレスポンスヘッダ
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(*keys: Any) -> str:
+    """ページの最後の行のソートキーから、次のページを取得するためのカーソルを生成する
+    クライアントには中身に依存させないため、base64urlでエンコードした不透明な文字列として返す
+    """
+    raw = json.dumps(list(keys), separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def decode_cursor(cursor: str, size: int) -> Tuple[Any, ...]:
+    """カーソルをソートキーのタプルに戻す。不正なカーソルの場合は400エラー"""
+    try:
+        keys = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        keys = None
+    if not isinstance(keys, list) or len(keys) != size:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+    return tuple(keys)
+
+
+def set_next_cursor(response: Response, rows: Sequence[Any], limit: int, *key_attrs: str) -> Optional[str]:
+    """取得した行数が limit に達していれば、最後の行から次のページのカーソルをヘッダに設定する"""
+    if limit <= 0 or len(rows) < limit:
+        return None
+    last = rows[-1]
+    cursor = encode_cursor(*(getattr(last, attr) for attr in key_attrs))
+    response.headers[NEXT_CURSOR_HEADER] = cursor
+    return cursor
@@ -1,7 +1,7 @@
 import enum
-from typing import Dict, Set, List, Callable
-from model import User, RoleType
-from functools import wraps
+from typing import Dict, Set, Iterable, FrozenSet
+from model import RoleType
+from functools import lru_cache
 
 # 権限の定義
 class PermissionType(enum.Enum):
@@ -13,6 +13,18 @@ class PermissionType(enum.Enum):
     ITEM_READ   = "ITEM_READ"
     ITEM_UPDATE = "ITEM_UPDATE"
     ITEM_DELETE = "ITEM_DELETE"
+    SYSTEM_READ = "SYSTEM_READ"  # 運用向けの内部API (統計情報など) の参照
+
+
+# 権限ごとのビット。PermissionTypeの定義順に 1, 2, 4, 8, ... を割り当てる
+_PERMISSION_BITS: Dict[PermissionType, int] = {p: 1 << i for i, p in enumerate(PermissionType)}
+
+
+def _to_mask(permissions: Iterable[PermissionType]) -> int:
+    mask = 0
+    for permission in permissions:
+        mask |= _PERMISSION_BITS[permission]
+    return mask
 
 
 # 権限を扱うユーティリティクラス
@@ -28,6 +40,7 @@ class PermissionService:
             PermissionType.ITEM_READ,
             PermissionType.ITEM_UPDATE,
             PermissionType.ITEM_DELETE,
+            PermissionType.SYSTEM_READ,
         ]),
         RoleType.LOCATION_ADMIN: set([  # LOCATION_ADMIN が保有する権限
             PermissionType.USER_READ,
@@ -45,17 +58,31 @@ class PermissionService:
         ])
     }
 
-    @classmethod
-    def has_permission(cls, user: User, permissions: List[PermissionType]) -> bool:
-        """引数で受け取った権限を有しているかを確認するメソッド"""
-        required_permissions = set(permissions)
-        user_permissions = cls.get_permissions(user)
-        return len(required_permissions) == len(required_permissions & user_permissions)
+    # ロールごとの権限をインポート時にビットマスクへ変換しておく
+    __role_masks: Dict[RoleType, int] = {
+        role: _to_mask(permissions) for role, permissions in __role_definition.items()
+    }
+
+    @staticmethod
+    def permission_mask(permissions: Iterable[PermissionType]) -> int:
+        """権限の一覧をビットマスクに変換するメソッド"""
+        return _to_mask(permissions)
 
     @classmethod
-    def get_permissions(cls, user: User) -> Set[PermissionType]:
-        """ユーザーが保持している権限を取得するメソッド"""
-        ret = set()
-        for role in user.roles:
-            ret = ret | cls.__role_definition.get(role.name, set())
-        return ret
\ No newline at end of file
+    @lru_cache(maxsize=None)
+    def get_role_mask(cls, roles: FrozenSet[RoleType]) -> int:
+        """ロールの組み合わせが保持する権限のビットマスクを取得するメソッド (組み合わせごとにメモ化)"""
+        mask = 0
+        for role in roles:
+            mask |= cls.__role_masks.get(role, 0)
+        return mask
+
+    @staticmethod
+    def has_mask(user_mask: int, required_mask: int) -> bool:
+        """ビットマスクで権限を確認するメソッド"""
+        return user_mask & required_mask == required_mask
+
+    @staticmethod
+    def get_mask_permissions(mask: int) -> Set[PermissionType]:
+        """ビットマスクを権限の集合に戻すメソッド"""
+        return {p for p, bit in _PERMISSION_BITS.items() if mask & bit}
\ No newline at end of file
@@ -0,0 +1,76 @@
+import logging
+import threading
+import time
+from typing import Any, Dict
+
+from sqlalchemy import exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+
+logger = logging.getLogger(__name__)
+
+
+class _PoolStatsMixin:
+    """コネクションの取得待ち時間とタイムアウト回数を記録するQueuePoolの拡張
+
+    QueuePoolは空きがないとき、リクエストを黙って pool_timeout 秒まで待たせるため、
+    待ち時間を計測してログと /internal/stats で確認できるようにする。
+    """
+
+    # 取得待ちがこの秒数を超えたら警告ログを出力する
+    wait_warning_seconds: float = 0.1
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self._checkouts = 0
+        self._timeouts = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self._timeouts += 1
+            logger.error("connection pool timed out: %s", self.stats())
+            raise
+        finally:
+            wait = time.perf_counter() - start
+            with self._stats_lock:
+                self._checkouts += 1
+                self._total_wait += wait
+                self._max_wait = max(self._max_wait, wait)
+            if wait > self.wait_warning_seconds:
+                logger.warning("waited %.3fs for a pooled connection: %s", wait, self.stats())
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return {
+                "size": self.size(),
+                "checked_in": self.checkedin(),
+                "checked_out": self.checkedout(),
+                "overflow": self.overflow(),
+                "checkouts": self._checkouts,
+                "timeouts": self._timeouts,
+                "avg_wait_ms": (self._total_wait / self._checkouts * 1000) if self._checkouts else 0.0,
+                "max_wait_ms": self._max_wait * 1000,
+            }
+
+
+class InstrumentedQueuePool(_PoolStatsMixin, QueuePool):
+    pass
+
+
+class InstrumentedAsyncAdaptedQueuePool(_PoolStatsMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def get_pool_stats(engine: Engine) -> Dict[str, Any]:
+    """エンジンのコネクションプールの状態を返す"""
+    pool = engine.pool
+    if isinstance(pool, _PoolStatsMixin):
+        return pool.stats()
+    return {"status": pool.status()}
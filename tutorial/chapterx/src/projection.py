@@ -0,0 +1,40 @@
+from typing import List, Optional, Sequence
+
+from fastapi import HTTPException
+
+from model import Item
+
+# 一覧APIの fields パラメータで指定できるアイテムの項目
+ITEM_FIELDS = {
+    "id": Item.id,
+    "title": Item.title,
+    "content": Item.content,
+    "created": Item.created,
+    "updated": Item.updated,
+}
+# fields を指定しない場合の項目 (従来のレスポンスと同じ)
+ITEM_DEFAULT_FIELDS = ["id", "title", "content"]
+# summary=true の場合の項目。MEDIUMTEXTの content を読み込まない
+ITEM_SUMMARY_FIELDS = ["id", "title", "updated"]
+
+
+def parse_fields(fields: Optional[str], summary: bool) -> List[str]:
+    """fields パラメータ ("id,title" 形式) を項目名のリストに変換する。 id は常に含める"""
+    if summary:
+        return ITEM_SUMMARY_FIELDS
+    if fields is None:
+        return ITEM_DEFAULT_FIELDS
+    names = ["id"] + [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in ITEM_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields. ({', '.join(unknown)})")
+    return list(dict.fromkeys(names))
+
+
+def item_columns(names: Sequence[str]) -> list:
+    """項目名に対応するカラム。キーセットページネーション用に user_id も取得する"""
+    return [Item.user_id] + [ITEM_FIELDS[name] for name in names]
+
+
+def to_dicts(rows: Sequence, names: Sequence[str]) -> List[dict]:
+    return [{name: getattr(row, name) for name in names} for row in rows]
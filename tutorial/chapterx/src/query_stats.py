@@ -0,0 +1,155 @@
+import json
+import logging
+import os
+import re
+import time
+import traceback
+from collections import Counter
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from env import Environment
+
+logger = logging.getLogger(__name__)
+
+_env = Environment()
+
+# リクエスト中に発行されたSQLの統計。ミドルウェアがリクエストごとに設定する
+_current: ContextVar[Optional["QueryStats"]] = ContextVar("query_stats", default=None)
+
+# 呼び出し元の特定で読み飛ばすファイル (SQLAlchemy内部とこのモジュール)
+_SKIP_PATHS = (os.path.dirname(sqlalchemy.__file__), __file__)
+
+
+def _shape(statement: str) -> str:
+    """IN句のプレースホルダの個数や空白の違いを無視した、SQLの形を返す"""
+    statement = re.sub(r"\((?:\s*(?:%s|\?|%\(\w+\)s)\s*,)*\s*(?:%s|\?|%\(\w+\)s)\s*\)", "(?)", statement)
+    return " ".join(statement.split())
+
+
+def _call_site() -> Optional[str]:
+    """SQLを発行したアプリケーションのコードの位置を返す"""
+    for frame in reversed(traceback.extract_stack()):
+        if not frame.filename.startswith(_SKIP_PATHS) and "site-packages" not in frame.filename:
+            return f"{frame.filename}:{frame.lineno} in {frame.name}"
+    return None
+
+
+class QueryStats:
+    """1リクエストで発行されたSQLの件数・合計時間・遅いSQLを集計する
+
+    - 同じ形のSQLが n_plus_one_threshold 回を超えて発行された場合は、N+1の疑いとして報告する
+    - slow_query_ms 以上かかったSQLは、パラメータと呼び出し元とともに記録する
+    """
+
+    def __init__(self, slow_query_ms: float, n_plus_one_threshold: int, top: int = 3):
+        self.slow_query_ms = slow_query_ms
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.top = top
+        self.count = 0
+        self.total_ms = 0.0
+        self.shapes: Counter = Counter()
+        self.slowest: List[Dict[str, Any]] = []
+        self.slow_queries: List[Dict[str, Any]] = []
+
+    def record(self, statement: str, parameters: Any, elapsed_ms: float) -> None:
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.shapes[_shape(statement)] += 1
+
+        self.slowest.append({"statement": statement, "ms": round(elapsed_ms, 3)})
+        self.slowest.sort(key=lambda s: s["ms"], reverse=True)
+        del self.slowest[self.top:]
+
+        if elapsed_ms >= self.slow_query_ms:
+            self.slow_queries.append({
+                "statement": statement,
+                "parameters": repr(parameters),
+                "ms": round(elapsed_ms, 3),
+                "call_site": _call_site(),
+            })
+
+    def n_plus_one(self) -> Dict[str, int]:
+        """N+1の疑いがあるSQLの形と、その発行回数"""
+        return {shape: n for shape, n in self.shapes.items() if n > self.n_plus_one_threshold}
+
+    def server_timing(self) -> str:
+        """Server-Timing ヘッダの値 https://developer.mozilla.org/docs/Web/HTTP/Headers/Server-Timing"""
+        return f'db;dur={self.total_ms:.3f};desc="{self.count} statements"'
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "db_statements": self.count,
+            "db_time_ms": round(self.total_ms, 3),
+            "slowest": self.slowest,
+            "slow_queries": self.slow_queries,
+            "n_plus_one": self.n_plus_one(),
+        }
+
+
+def start() -> QueryStats:
+    """現在のリクエスト(コンテキスト)の集計を開始する"""
+    stats = QueryStats(_env.sql_slow_query_ms, _env.sql_n_plus_one_threshold)
+    _current.set(stats)
+    return stats
+
+
+def current() -> Optional[QueryStats]:
+    return _current.get()
+
+
+def configure_logging(level: str) -> None:
+    """集計結果のログを標準エラー出力に出力する
+
+    uvicornは自身のロガーしか設定しないため、アプリの起動時に呼び出す。
+    ルートロガーが設定済みの場合は、そちらのハンドラに任せる。
+    """
+    if not level:
+        return
+    logger.setLevel(level.upper())
+    if not logger.handlers and not logging.getLogger().handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+        logger.addHandler(handler)
+
+
+def log(stats: QueryStats, method: str, path: str, status_code: int) -> None:
+    """リクエストの集計結果を1行のJSONでログに出力する"""
+    record = {"method": method, "path": path, "status": status_code, **stats.to_dict()}
+    if record["n_plus_one"] or record["slow_queries"]:
+        logger.warning(json.dumps(record, ensure_ascii=False))
+    else:
+        logger.info(json.dumps(record, ensure_ascii=False))
+
+
+def log_stream(stats: QueryStats, name: str, rows: int, elapsed_ms: float) -> None:
+    """ストリーミングレスポンスの送信で発行されたSQLの集計結果を、送信の完了時にログに出力する"""
+    record = {"stream": name, "rows": rows, "stream_ms": round(elapsed_ms, 3), **stats.to_dict()}
+    logger.info(json.dumps(record, ensure_ascii=False))
+
+
+# すべてのエンジン (AsyncEngineの内部の同期エンジンを含む) のSQLを計測する
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    starts = conn.info.get("query_start")
+    if stats is None or not starts:
+        return
+    stats.record(statement, parameters, (time.perf_counter() - starts.pop()) * 1000)
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(exception_context):
+    starts = exception_context.connection.info.get("query_start") if exception_context.connection else None
+    if starts:
+        starts.pop()
@@ -0,0 +1,83 @@
+import base64
+import hashlib
+import hmac
+import secrets
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+from sqlalchemy import delete
+from sqlalchemy.orm import Session
+
+from model import RefreshToken
+from env import Environment
+
+# リフレッシュトークンの形式: "{ランダム値}.{ランダム値のHMAC-SHA256署名}"
+# 署名の検証はDBにアクセスせずに行えるため、不正なトークンは安価に弾ける。
+# DBにはトークン全体のSHA-256ハッシュを保存し、1度使われたトークンは削除する (ローテーション)
+
+
+def _sign(value: str, secret: str) -> str:
+    digest = hmac.new(secret.encode("utf-8"), value.encode("utf-8"), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode("ascii")
+
+
+def _hash(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def _verify_signature(token: str, secret: str) -> bool:
+    value, _, signature = token.partition(".")
+    return bool(value) and hmac.compare_digest(signature, _sign(value, secret))
+
+
+def issue_refresh_token(session: Session, user_id: int) -> str:
+    """リフレッシュトークンを発行してセッションに追加する (commitは呼び出し側で行う)"""
+    env = Environment()
+    value = secrets.token_urlsafe(32)
+    token = f"{value}.{_sign(value, env.token_secret_key)}"
+    session.add(RefreshToken(
+        user_id=user_id,
+        token_hash=_hash(token),
+        expires=datetime.now() + timedelta(minutes=env.refresh_token_expire_minutes),
+    ))
+    return token
+
+
+def rotate_refresh_token(session: Session, token: str) -> Optional[Tuple[int, str]]:
+    """リフレッシュトークンを検証し、使用済みとして削除した上で新しいトークンを発行する
+    成功した場合は (user_id, 新しいリフレッシュトークン) を返す。無効なトークンの場合はNoneを返す
+    """
+    env = Environment()
+    if not _verify_signature(token, env.token_secret_key):
+        return None
+
+    row = session.query(RefreshToken).filter(RefreshToken.token_hash == _hash(token)).first()
+    if row is None:
+        return None
+    if row.expires <= datetime.now():
+        return None
+
+    # 同じトークンが同時に使われた場合でも、削除に成功した1リクエストだけを有効とする
+    result = session.execute(
+        delete(RefreshToken).where(RefreshToken.id == row.id),
+        execution_options={"synchronize_session": False},
+    )
+    if result.rowcount != 1:
+        return None
+    return row.user_id, issue_refresh_token(session, row.user_id)
+
+
+def revoke_refresh_tokens(session: Session, user_id: int) -> None:
+    """ユーザーのリフレッシュトークンをすべて削除する (commitは呼び出し側で行う)"""
+    session.execute(
+        delete(RefreshToken).where(RefreshToken.user_id == user_id),
+        execution_options={"synchronize_session": False},
+    )
+
+
+def revoke_refresh_token(session: Session, user_id: int, token: str) -> None:
+    """ユーザーのリフレッシュトークンを1件削除する (commitは呼び出し側で行う)"""
+    session.execute(
+        delete(RefreshToken).where(RefreshToken.user_id == user_id, RefreshToken.token_hash == _hash(token)),
+        execution_options={"synchronize_session": False},
+    )
@@ -0,0 +1,76 @@
+import random
+import threading
+import time
+from typing import Callable, Dict, Generic, List, Optional, TypeVar
+
+from starlette.requests import Request
+
+F = TypeVar("F", bound=Callable)
+
+# 参照系のメソッド。これ以外のメソッドのリクエストはプライマリで処理する
+READ_METHODS = frozenset(["GET", "HEAD", "OPTIONS"])
+
+
+class StickyClients:
+    """書き込みを行ったクライアントを一定時間記録する
+
+    レプリカへの反映には遅延があるため、書き込み直後のクライアントの参照をプライマリに向け、
+    自分が作成・更新したデータが見えない (read-your-writes が崩れる) ことを防ぐ。
+    """
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self._lock = threading.Lock()
+        self._until: Dict[str, float] = {}
+
+    def mark(self, key: str) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._until[key] = now + self.seconds
+            # 期限切れのエントリを掃除して、クライアント数に比例して増え続けないようにする
+            if len(self._until) > 1024:
+                self._until = {k: v for k, v in self._until.items() if v > now}
+
+    def is_sticky(self, key: str) -> bool:
+        with self._lock:
+            until = self._until.get(key)
+        return until is not None and until > time.monotonic()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._until.clear()
+
+
+class ReplicaRouter(Generic[F]):
+    """リクエストに応じて、プライマリとレプリカのどちらのセッションファクトリーを使うかを決める
+
+    - 参照系メソッド (GET など) のリクエストはレプリカ (複数ある場合はランダム) に振り分ける
+    - それ以外 (作成・更新・削除・/token など) はプライマリで処理する
+    - 書き込みを行ったクライアントは sticky_seconds 秒間、参照もプライマリで処理する
+      クライアントは Authorization ヘッダ (ユーザーごとのトークン) で識別する
+    """
+
+    def __init__(self, primary: F, replicas: List[F], sticky_seconds: float):
+        self.primary = primary
+        self.replicas = replicas
+        self.sticky = StickyClients(sticky_seconds)
+
+    def select(self, request: Optional[Request]) -> F:
+        if request is None or not self.replicas:
+            return self.primary
+        key = request.headers.get("Authorization")
+        if request.method not in READ_METHODS:
+            if key is not None:
+                self.sticky.mark(key)
+            return self.primary
+        if key is not None and self.sticky.is_sticky(key):
+            return self.primary
+        return random.choice(self.replicas)
+
+    def release(self, request: Optional[Request]) -> None:
+        """リクエストの処理後に呼び出す。書き込みの完了時点からスティッキー期間を数え直す"""
+        if request is None or not self.replicas or request.method in READ_METHODS:
+            return
+        key = request.headers.get("Authorization")
+        if key is not None:
+            self.sticky.mark(key)
@@ -0,0 +1,181 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, exists, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from model import RevokedToken
+
+
+class BloomFilter:
+    """集合に含まれるかどうかを確率的に判定するフィルタ
+    「含まれない」という判定は必ず正しく、「含まれる」という判定は偽陽性の可能性がある
+    """
+
+    def __init__(self, bits: int, hashes: int):
+        self.bits = bits
+        self.hashes = hashes
+        self._array = bytearray((bits + 7) // 8)
+
+    def add(self, key: str) -> None:
+        for position in self._positions(key):
+            self._array[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._array[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def _positions(self, key: str):
+        # SHA-256のダイジェストから2つのハッシュ値を取り出し、double hashingでk個の位置を求める
+        digest = hashlib.sha256(key.encode("utf-8")).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:16], "little") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+
+class RevocationList:
+    """失効したトークン(jti)をワーカープロセス内で判定するクラス
+
+    - revoked_tokens テーブルの有効期限内のjtiをBloomフィルタに、最近のjtiを正確な集合に保持する
+    - Bloomフィルタに含まれないjtiは、DBを参照せずに「失効していない」と判定できる
+    - Bloomフィルタが陽性かつ最近の集合にない場合のみ、DBで確認する
+    - reload_interval 秒ごとに、前回の読み込みの reload_overlap 秒前以降に作成された行を読み込む
+      (idの順に読み込むと、先に採番されて後からコミットされた行を読み飛ばすことがあるため、時刻の範囲で読み込む)
+    - rebuild_interval 秒ごとに、有効期限内の行だけからBloomフィルタを作り直す
+      (追加するだけでは偽陽性率が上がり続け、DBでの確認が増えていくため)
+    """
+
+    def __init__(
+        self,
+        bloom_bits: int,
+        bloom_hashes: int,
+        recent_size: int,
+        reload_interval: float,
+        reload_overlap: float,
+        rebuild_interval: float,
+    ):
+        self.bloom_bits = bloom_bits
+        self.bloom_hashes = bloom_hashes
+        self.recent_size = recent_size
+        self.reload_interval = reload_interval
+        self.reload_overlap = reload_overlap
+        self.rebuild_interval = rebuild_interval
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self.clear()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._bloom = BloomFilter(self.bloom_bits, self.bloom_hashes)
+            self._recent: "OrderedDict[str, None]" = OrderedDict()
+            self._since = datetime.min
+            self._next_reload = 0.0
+            self._next_rebuild = 0.0
+            self._added_while_rebuilding: Optional[List[str]] = None
+
+    def add(self, jti: str) -> None:
+        """このプロセスで失効させたjtiを即座に反映する"""
+        with self._lock:
+            self._add(self._bloom, self._recent, jti)
+            if self._added_while_rebuilding is not None:
+                self._added_while_rebuilding.append(jti)
+
+    def is_revoked(self, session: Session, jti: str) -> bool:
+        self.reload_if_due(session)
+        with self._lock:
+            if jti not in self._bloom:
+                return False
+            if jti in self._recent:
+                return True
+        return session.query(exists().where(RevokedToken.jti == jti)).scalar()
+
+    def reload_if_due(self, session: Session) -> None:
+        """前回の読み込みから reload_interval 秒経過していれば、追加された行を読み込む
+        rebuild_interval 秒経過していれば、Bloomフィルタを作り直す
+        他のスレッドが読み込み中の場合は待たずに戻る
+        """
+        now = time.monotonic()
+        if now < self._next_reload:
+            return
+        if not self._reload_lock.acquire(blocking=False):
+            return
+        try:
+            if now >= self._next_rebuild:
+                self._rebuild(session)
+            else:
+                self._reload(session)
+        finally:
+            self._reload_lock.release()
+
+    def _reload(self, session: Session) -> None:
+        started = datetime.now()
+        jtis = session.scalars(
+            select(RevokedToken.jti)
+            .where(RevokedToken.created >= self._since)
+            .order_by(RevokedToken.created)
+        ).all()
+        with self._lock:
+            for jti in jtis:
+                self._add(self._bloom, self._recent, jti)
+            self._since = started - timedelta(seconds=self.reload_overlap)
+            self._next_reload = time.monotonic() + self.reload_interval
+
+    def _rebuild(self, session: Session) -> None:
+        started = datetime.now()
+        with self._lock:
+            self._added_while_rebuilding = []
+        try:
+            jtis = session.scalars(
+                select(RevokedToken.jti)
+                .where(RevokedToken.expires > started)
+                .order_by(RevokedToken.created)
+            ).all()
+        except Exception:
+            with self._lock:
+                self._added_while_rebuilding = None
+            raise
+        bloom = BloomFilter(self.bloom_bits, self.bloom_hashes)
+        recent: "OrderedDict[str, None]" = OrderedDict()
+        for jti in jtis:
+            self._add(bloom, recent, jti)
+        with self._lock:
+            # 読み込み中にこのプロセスで失効させたjtiを引き継ぐ
+            for jti in self._added_while_rebuilding:
+                self._add(bloom, recent, jti)
+            self._added_while_rebuilding = None
+            self._bloom = bloom
+            self._recent = recent
+            self._since = started - timedelta(seconds=self.reload_overlap)
+            self._next_reload = time.monotonic() + self.reload_interval
+            self._next_rebuild = time.monotonic() + self.rebuild_interval
+
+    def _add(self, bloom: BloomFilter, recent: "OrderedDict[str, None]", jti: str) -> None:
+        bloom.add(jti)
+        recent[jti] = None
+        recent.move_to_end(jti)
+        while len(recent) > self.recent_size:
+            recent.popitem(last=False)
+
+
+def revoke_token(session: Session, jti: str, expires: datetime) -> None:
+    """jtiを revoked_tokens テーブルに登録する (commitは呼び出し側で行う)
+
+    同じjtiが同時に失効された場合は一意制約の違反になるため、セーブポイントだけをロールバックし、
+    失効済みとして扱う。
+    """
+    try:
+        with session.begin_nested():
+            session.add(RevokedToken(jti=jti, expires=expires))
+    except IntegrityError:
+        pass
+
+
+def purge_expired(session: Session) -> int:
+    """有効期限を過ぎた行を削除し、削除した件数を返す (commitは呼び出し側で行う)
+    期限切れのトークンは検証時に拒否されるため、失効の記録は不要になる
+    """
+    return session.execute(delete(RevokedToken).where(RevokedToken.expires <= datetime.now())).rowcount
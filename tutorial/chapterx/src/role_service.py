@@ -0,0 +1,37 @@
+from typing import Iterable, List
+
+from sqlalchemy.orm import Session
+
+from model import Role, RoleType
+
+
+class RoleNotFoundError(Exception):
+    """指定されたロールが存在しないときに送出される例外。 missing に見つからなかったid(または名前)を持つ"""
+
+    def __init__(self, missing: List):
+        super().__init__(f"Role is not found. ({', '.join(str(m) for m in missing)})")
+        self.missing = missing
+
+
+def get_roles_by_ids(session: Session, role_ids: Iterable[int]) -> List[Role]:
+    """idのリストからロールを1回のSELECT (IN句) で取得する。結果は指定された順に並べる"""
+    role_ids = list(dict.fromkeys(role_ids))
+    if not role_ids:
+        return []
+    roles = {role.id: role for role in session.query(Role).filter(Role.id.in_(role_ids))}
+    missing = [role_id for role_id in role_ids if role_id not in roles]
+    if missing:
+        raise RoleNotFoundError(missing)
+    return [roles[role_id] for role_id in role_ids]
+
+
+def get_roles_by_names(session: Session, names: Iterable[RoleType]) -> List[Role]:
+    """ロール名のリストからロールを1回のSELECT (IN句) で取得する。結果は指定された順に並べる"""
+    names = [RoleType(name) for name in dict.fromkeys(names)]
+    if not names:
+        return []
+    roles = {role.name: role for role in session.query(Role).filter(Role.name.in_(names))}
+    missing = [name.value for name in names if name not in roles]
+    if missing:
+        raise RoleNotFoundError(missing)
+    return [roles[name] for name in names]
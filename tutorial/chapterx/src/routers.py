@@ -1,49 +1,78 @@
-from typing import List
-from datetime import timedelta, datetime, UTC
+from typing import List, Optional
+from datetime import timedelta, datetime
 
-from sqlalchemy import and_
-from sqlalchemy.orm import Session
-from fastapi import Depends, APIRouter, HTTPException
+from sqlalchemy import and_, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session, selectinload, undefer
+from sqlalchemy.orm import Query as OrmQuery  # クエリパラメータの Query と区別する
+from fastapi import Depends, APIRouter, HTTPException, Query, Request, Response, status
 from fastapi.security import OAuth2PasswordRequestForm
-from fastapi import Depends, APIRouter, HTTPException, status
-from jose import jwt, JWTError
+from fastapi.concurrency import run_in_threadpool
 
-from session import get_session
+from session import get_session, SessionReleasingRoute
 from model import User, Item, Role
 import auth
+from hasher import HashingOverloadedError
 from env import Environment
 from schemas import (
     UserResponseSchema,
     UserPostSchema,
     UserPutSchema,
     ItemResponseSchema,
+    ItemListResponseSchema,
+    ItemIdsSchema,
+    MAX_BULK_IDS,
     ItemPostSchema,
     ItemPutSchema,
+    ItemPatchSchema,
+    ItemPatchResponseSchema,
+    RefreshTokenSchema,
+    LogoutSchema,
+    RevokeTokenSchema,
+    BatchRequestSchema,
 )
+from refresh_token import issue_refresh_token, rotate_refresh_token, revoke_refresh_token, revoke_refresh_tokens
+from revocation import revoke_token
+from pagination import decode_cursor, set_next_cursor
+from projection import ITEM_FIELDS, parse_fields, item_columns, to_dicts
+from export import export_response, check_format
+import item_import
+from item_import import insert_batch
+from role_service import get_roles_by_ids, RoleNotFoundError
+import batch
 
 from permission_service import PermissionType
 
 
-router = APIRouter()
+router = APIRouter(route_class=SessionReleasingRoute)
+
+def _query_users(session: Session) -> OrmQuery:
+    """ユーザーを取得するクエリ。
+    レスポンス(UserResponseSchema)で参照するロールは、取得したユーザー分をまとめて1回のSELECTで読み込む
+    (ユーザーごとに遅延読み込みすると、N件のユーザーに対してN回のSELECTが発行される)
+    """
+    return session.query(User).options(selectinload(User.roles))
+
+def _get_roles(session: Session, role_ids: List[int]) -> List[Role]:
+    """idからロールを1回のSELECTで取得する。存在しないidがあれば、すべてのidを含めて404エラー"""
+    try:
+        return get_roles_by_ids(session, role_ids)
+    except RoleNotFoundError as e:
+        raise HTTPException(status_code=404, detail=f"Role is not found. (id={', '.join(map(str, e.missing))})")
 
 # ユーザー作成
 @router.post("/users/", response_model=UserResponseSchema)
 def create_user(
     data: UserPostSchema, 
     session: Session = Depends(get_session),
-    _: User = Depends(auth.get_current_user([PermissionType.USER_CREATE]))
+    _: auth.Principal = Depends(auth.get_current_user([PermissionType.USER_CREATE]))
 ):
     user = session.query(User).filter(User.username == data.username).first()
     if user:
         raise HTTPException(status_code=400, detail=f"{data.username} is already exists.")
 
     # idからロールを取得
-    roles = []
-    for role_id in data.role_ids:
-        role = session.query(Role).filter(Role.id == role_id).first()
-        if role is None:
-            raise HTTPException(status_code=404, detail=f"Role is not found. (id={role_id})")
-        roles.append(role)
+    roles = _get_roles(session, data.role_ids)
 
     user = User(
         username=data.username,
@@ -53,28 +82,49 @@ def create_user(
     )
     session.add(user)
     session.commit()
-    session.refresh(user)
-    return user
+    return _query_users(session).filter(User.id == user.id).first()
 
 # ユーザー一覧
 @router.get("/users/", response_model=List[UserResponseSchema])
 def read_users(
+    response: Response,
     skip: int = 0,  # GETパラメータ
     limit: int = 100,  # GETパラメータ
+    cursor: Optional[str] = None,  # 前のページの X-Next-Cursor。指定した場合は skip を無視する
     session: Session = Depends(get_session),
-    _: User = Depends(auth.get_current_user([PermissionType.USER_READ]))
+    _: auth.Principal = Depends(auth.get_current_user([PermissionType.USER_READ]))
 ):
-    users = session.query(User).offset(skip).limit(limit).all()
+    query = _query_users(session).order_by(User.id)
+    if cursor is None:
+        query = query.offset(skip)
+    else:
+        # キーセットページネーション: 前のページの最後のidより後ろを主キーの範囲検索で取得する
+        (last_id,) = decode_cursor(cursor, 1)
+        query = query.filter(User.id > last_id)
+    users = query.limit(limit).all()
+    set_next_cursor(response, users, limit, "id")
     return users
 
+# ユーザーのエクスポート
+# 全ユーザーを NDJSON (format=ndjson) または CSV (format=csv) でストリーミングする
+@router.get("/users/export")
+def export_users(
+    format: str = "ndjson",
+    session: Session = Depends(get_session),
+    _: auth.Principal = Depends(auth.get_current_user([PermissionType.USER_READ]))
+):
+    names = ["id", "username", "age", "created", "updated"]
+    stmt = select(*[getattr(User, name) for name in names]).order_by(User.id)
+    return export_response(session.get_bind(), stmt, names, format, "users")
+
 # ユーザー取得
 @router.get("/users/{user_id}", response_model=UserResponseSchema)
 def read_user(
     user_id: int,
     session: Session = Depends(get_session),
-    _: User = Depends(auth.get_current_user([PermissionType.USER_READ]))
+    _: auth.Principal = Depends(auth.get_current_user([PermissionType.USER_READ]))
 ):
-    user = session.query(User).filter(User.id == user_id).first()
+    user = _query_users(session).filter(User.id == user_id).first()
     if user is None:
         raise HTTPException(status_code=404, detail=f"User is not found. (id={user_id})")
     return user
@@ -85,7 +135,7 @@ def update_user(
     user_id: int,
     data: UserPutSchema,
     session: Session = Depends(get_session),
-    _: User = Depends(auth.get_current_user([PermissionType.USER_UPDATE]))
+    _: auth.Principal = Depends(auth.get_current_user([PermissionType.USER_UPDATE]))
 ):
     # ユーザーの存在チェック。更新対象のユーザーが存在しなければ404エラー
     user = session.query(User).filter(User.id == user_id).first()
@@ -93,35 +143,39 @@ def update_user(
         raise HTTPException(status_code=404, detail=f"User is not found. (id={user_id})")
 
     # idからロールを取得
-    roles = []
-    for role_id in data.role_ids:
-        role = session.query(Role).filter(Role.id == role_id).first()
-        if role is None:
-            raise HTTPException(status_code=404, detail=f"Role is not found. (id={role_id})")
-        roles.append(role)
+    roles = _get_roles(session, data.role_ids)
 
     # リクエストで受け取った password と age を設定して保存
     user.hashed_password = auth.hash(data.password)
     user.age = data.age
     user.roles = roles
+    # トークンバージョンを上げて、発行済みのステートレストークンを失効させる
+    user.token_version = user.token_version + 1
     session.add(user)
+    # パスワードが変わるため、発行済みのリフレッシュトークンも失効させる
+    revoke_refresh_tokens(session, user_id)
     session.commit()
-    session.refresh(user)
-    return user
+    # 権限が変わる可能性があるため、キャッシュ済みの認証結果を破棄する
+    auth.token_cache.invalidate_user(user_id)
+    auth.token_versions.set(user_id, user.token_version)
+    return _query_users(session).filter(User.id == user_id).first()
 
 # ユーザー削除
 @router.delete("/users/{user_id}")
 def delete_user(
     user_id: int,
     session: Session = Depends(get_session),
-    _: User = Depends(auth.get_current_user([PermissionType.USER_DELETE]))
+    _: auth.Principal = Depends(auth.get_current_user([PermissionType.USER_DELETE]))
 ):
     # ユーザーの存在チェック。更新対象のユーザーが存在しなければ404エラー
     user = session.query(User).filter(User.id == user_id).first()
     if user is None:
         raise HTTPException(status_code=404, detail=f"User is not found. (id={user_id})")
+    # アイテム・ロールの割り当て・リフレッシュトークンはDBのカスケードで削除される
     session.delete(user)
     session.commit()
+    auth.token_cache.invalidate_user(user_id)
+    auth.token_versions.invalidate(user_id)
     return {"user_id": user_id}
 
 # トークン取得API
@@ -130,10 +184,9 @@ def login_for_access_token(
     session: Session = Depends(get_session),
     form_data: OAuth2PasswordRequestForm = Depends()
 ):
-    env = Environment()
     # OAuth2PasswordRequestForm は username, password, scope, grant_type といったメンバを持つ
     # https://fastapi.tiangolo.com/tutorial/security/simple-oauth2/#oauth2passwordrequestform
-    user = session.query(User).filter(User.username == form_data.username).first()
+    user = session.query(User).options(undefer(User.hashed_password)).filter(User.username == form_data.username).first()
     if (user is None) or (not auth.verify_password(form_data.password, user.hashed_password)):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -141,16 +194,76 @@ def login_for_access_token(
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    payload={
-        # JWT "sub" Claim : https://openid-foundation-japan.github.io/draft-ietf-oauth-json-web-token-11.ja.html#subDef
-        "sub": user.username,
-        "scopes": [],
-        "exp": datetime.now(UTC) + timedelta(minutes=env.token_expire_minutes)
-    }
+    # コストが設定値と異なる場合は、平文のパスワードが手元にあるこのタイミングでハッシュを再計算する
+    if auth.needs_rehash(user.hashed_password):
+        try:
+            user.hashed_password = auth.hash(form_data.password)
+            session.commit()
+        except HashingOverloadedError:
+            # 混雑時は再計算を次回のログインに見送る
+            pass
+
+    refresh_token = issue_refresh_token(session, user.id)
+    session.commit()
+    return _token_response(user, refresh_token)
+
+# トークン更新API
+# パスワードの代わりにリフレッシュトークンを受け取り、新しいアクセストークンとリフレッシュトークンを返す
+# (bcryptの計算は行わない。受け取ったリフレッシュトークンは使用済みとなる)
+@router.post("/token/refresh")
+def refresh_access_token(
+    data: RefreshTokenSchema,
+    session: Session = Depends(get_session),
+):
+    rotated = rotate_refresh_token(session, data.refresh_token)
+    user = None
+    if rotated is not None:
+        user_id, refresh_token = rotated
+        user = session.query(User).filter(User.id == user_id).first()
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid refresh token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    session.commit()
+    return _token_response(user, refresh_token)
+
+# ログアウトAPI
+# 利用中のアクセストークン (指定された場合はリフレッシュトークンも) を失効させる
+@router.post("/logout")
+def logout(
+    data: Optional[LogoutSchema] = None,
+    session: Session = Depends(get_session),
+    current_user: auth.Principal = Depends(auth.get_current_user()),
+):
+    if current_user.jti is None:
+        raise HTTPException(status_code=400, detail="This token cannot be revoked.")
+    revoke_token(session, current_user.jti, datetime.fromtimestamp(current_user.expires))
+    if data is not None and data.refresh_token is not None:
+        revoke_refresh_token(session, current_user.id, data.refresh_token)
+    session.commit()
+    auth.revocations.add(current_user.jti)
+    return {"jti": current_user.jti}
+
+# トークン失効API (管理者用)
+@router.post("/tokens/revoke")
+def revoke(
+    data: RevokeTokenSchema,
+    session: Session = Depends(get_session),
+    _: auth.Principal = Depends(auth.get_current_user([PermissionType.USER_UPDATE]))
+):
+    # 有効期限が分からないため、発行され得るトークンの最長の有効期限まで保持する
+    env = Environment()
+    revoke_token(session, data.jti, datetime.now() + timedelta(minutes=env.token_expire_minutes))
+    session.commit()
+    auth.revocations.add(data.jti)
+    return {"jti": data.jti}
 
-    # トークンの生成
-    access_token = jwt.encode(payload, env.token_secret_key, algorithm=env.token_algorithm)
-    return {"access_token": access_token, "token_type": "bearer"}
+def _token_response(user: User, refresh_token: str) -> dict:
+    """アクセストークンを生成し、トークンAPIのレスポンスを組み立てる"""
+    access_token = auth.create_access_token(user)
+    return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
 
 
 # アイテムの新規作成
@@ -159,75 +272,196 @@ def create(
     # request form and files: https://fastapi.tiangolo.com/tutorial/request-forms-and-files/
     data: ItemPostSchema,
     session: Session = Depends(get_session),
-    current_user: User = Depends(auth.get_current_user([PermissionType.ITEM_CREATE]))
+    current_user: auth.Principal = Depends(auth.get_current_user([PermissionType.ITEM_CREATE]))
 ):
-    item = Item(title=data.title, content=data.content)
-    current_user.items.append(item)
-    session.add(current_user)
+    item = Item(user_id=current_user.id, title=data.title, content=data.content)
+    session.add(item)
+    session.flush()  # INSERTしてidを採番する
+    item_id = item.id
     session.commit()
-    session.refresh(item)
-    return item
+    # commit後に再読み込みすると、遅延読み込みの content のSELECTも発行されるため、リクエストの値から返す
+    return {"id": item_id, "title": data.title, "content": data.content}
 
 
+# アイテムの一括登録
+# NDJSON (format=ndjson) または CSV (format=csv, 1行目はヘッダ) のボディを受信しながら1行ずつ検証し、
+# import_batch_size 件ずつ複数行のINSERTで登録する (バッチごとにコミット)
+# 不正な行は登録せずに行番号とともにレスポンスで返し、残りの行の登録は続ける
+@router.post("/items/import")
+async def import_items(
+    request: Request,
+    format: str = "ndjson",
+    session: Session = Depends(get_session),
+    current_user: auth.Principal = Depends(auth.get_current_user([PermissionType.ITEM_CREATE]))
+):
+    # ボディの受信は非同期で行い、DBへの登録は同期のセッションをスレッドプールで実行する
+    check_format(format)
+    async def insert_rows(rows, result):
+        await run_in_threadpool(insert_batch, session, rows, result)
+    result = await item_import.import_items(request.stream(), format, current_user.id, insert_rows)
+    return result.to_dict()
+
 # アイテムの一覧
-@router.get("/items/", response_model=List[ItemResponseSchema])
+# fields で返す項目を指定できる ("id,title,updated" など)。 summary=true は id, title, updated を返す
+# 指定された項目のカラムだけをSELECTするため、content を含めなければMEDIUMTEXTは読み込まない
+@router.get("/items/", response_model=List[ItemListResponseSchema], response_model_exclude_unset=True)
 def get_list(
+    response: Response,
     skip: int = 0,
     limit: int = 100,
+    cursor: Optional[str] = None,  # 前のページの X-Next-Cursor。指定した場合は skip を無視する
+    fields: Optional[str] = None,
+    summary: bool = False,
+    ids: Optional[List[int]] = Query(None, max_length=MAX_BULK_IDS),  # 指定した場合は、このidのアイテムだけを返す
+    session: Session = Depends(get_session),
+    current_user: auth.Principal = Depends(auth.get_current_user([PermissionType.ITEM_READ]))
+):
+    names = parse_fields(fields, summary)
+    if ids is not None:
+        return _get_items(session, current_user.id, ids, names)
+    # (user_id, id) の複合インデックスを使い、並べ替えなしで取得する
+    query = session.query(*item_columns(names)).filter(Item.user_id == current_user.id).order_by(Item.user_id, Item.id)
+    if cursor is None:
+        query = query.offset(skip)
+    else:
+        user_id, last_id = decode_cursor(cursor, 2)
+        if user_id != current_user.id:
+            raise HTTPException(status_code=400, detail="Invalid cursor.")
+        query = query.filter(Item.id > last_id)
+    rows = query.limit(limit).all()
+    set_next_cursor(response, rows, limit, "user_id", "id")
+    return to_dicts(rows, names)
+
+def _get_items(session: Session, user_id: int, ids: List[int], names: List[str]) -> List[dict]:
+    """指定されたidのアイテムを1回のSELECT (IN句) で取得する。他のユーザーのアイテムは含めない"""
+    rows = session.query(*item_columns(names)) \
+        .filter(and_(Item.user_id == user_id, Item.id.in_(ids))).order_by(Item.user_id, Item.id).all()
+    return to_dicts(rows, names)
+
+# アイテムの複数取得
+# GET /items/?ids=1&ids=2 と同じ。URLに収まらない数のidを指定する場合に利用する
+@router.post("/items/bulk-get", response_model=List[ItemListResponseSchema], response_model_exclude_unset=True)
+def bulk_get(
+    data: ItemIdsSchema,
+    fields: Optional[str] = None,
+    summary: bool = False,
+    session: Session = Depends(get_session),
+    current_user: auth.Principal = Depends(auth.get_current_user([PermissionType.ITEM_READ]))
+):
+    return _get_items(session, current_user.id, data.ids, parse_fields(fields, summary))
+
+# アイテムの一括削除
+# ログインユーザーのアイテムのうち、指定されたidのものを1回のDELETEで削除し、削除した件数を返す
+@router.post("/items/bulk-delete")
+def bulk_delete(
+    data: ItemIdsSchema,
+    session: Session = Depends(get_session),
+    current_user: auth.Principal = Depends(auth.get_current_user([PermissionType.ITEM_DELETE]))
+):
+    try:
+        deleted = session.query(Item).filter(and_(Item.user_id == current_user.id, Item.id.in_(data.ids))) \
+            .delete(synchronize_session=False)
+        session.commit()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+    return {"deleted": deleted}
+
+# アイテムのエクスポート
+# ログインユーザーの全アイテムを NDJSON (format=ndjson) または CSV (format=csv) でストリーミングする
+# fields で出力する項目を指定できる (一覧APIと同じ)
+@router.get("/items/export")
+def export_items(
+    format: str = "ndjson",
+    fields: Optional[str] = None,
     session: Session = Depends(get_session),
-    current_user: User = Depends(auth.get_current_user([PermissionType.ITEM_READ]))
+    current_user: auth.Principal = Depends(auth.get_current_user([PermissionType.ITEM_READ]))
 ):
-    items = session.query(Item).filter(Item.user_id == current_user.id).offset(skip).limit(limit).all()
-    return items
+    names = parse_fields(fields, False)
+    stmt = select(*[ITEM_FIELDS[name] for name in names]) \
+        .where(Item.user_id == current_user.id).order_by(Item.user_id, Item.id)
+    return export_response(session.get_bind(), stmt, names, format, "items")
 
 # アイテムの取得
 @router.get("/items/{item_id}", response_model=ItemResponseSchema)
 def get_item(
     item_id: int,
     session: Session = Depends(get_session),
-    _: User = Depends(auth.get_current_user([PermissionType.ITEM_READ]))
+    _: auth.Principal = Depends(auth.get_current_user([PermissionType.ITEM_READ]))
 ):
-    item = session.query(Item).filter(Item.id == item_id).first()
+    item = session.query(Item).options(undefer(Item.content)).filter(Item.id == item_id).first()
     if item is None:
         raise HTTPException(status_code=404, detail=f"Item is not found. (id={item_id})")
     return item
 
 
 # アイテムの更新
+# SELECTせずに条件付きのUPDATEを1回発行し、更新件数が0なら404とする
+# (レスポンスはリクエストの値から組み立てるため、更新後の再読み込みも行わない)
 @router.put("/items/{item_id}", response_model=ItemResponseSchema)
 def update(
     item_id: int,
     data: ItemPostSchema,
     session: Session = Depends(get_session),
-    current_user: User = Depends(auth.get_current_user([PermissionType.ITEM_UPDATE]))
+    current_user: auth.Principal = Depends(auth.get_current_user([PermissionType.ITEM_UPDATE]))
 ):
-    item = session.query(Item).filter(and_(Item.id == item_id, Item.user_id == current_user.id)).first()
-    if item is None:
-        raise HTTPException(status_code=404, detail="item not found")
+    values = {"title": data.title, "content": data.content}
+    return _update_item(session, item_id, current_user.id, values)
+
+# アイテムの部分更新
+# 指定した項目だけを更新する。タイトルだけを変える場合に content を送り直す必要がない
+@router.patch("/items/{item_id}", response_model=ItemPatchResponseSchema, response_model_exclude_unset=True)
+def patch(
+    item_id: int,
+    data: ItemPatchSchema,
+    session: Session = Depends(get_session),
+    current_user: auth.Principal = Depends(auth.get_current_user([PermissionType.ITEM_UPDATE]))
+):
+    values = data.model_dump(exclude_unset=True)
+    if not values:
+        raise HTTPException(status_code=400, detail="No fields to update.")
+    return _update_item(session, item_id, current_user.id, values)
 
+def _update_item(session: Session, item_id: int, user_id: int, values: dict) -> dict:
     try:
-        item.title = data.title
-        item.content = data.content
-        session.add(item)
+        updated = session.query(Item).filter(and_(Item.id == item_id, Item.user_id == user_id)) \
+            .update(values, synchronize_session=False)
         session.commit()
-        session.refresh(item)
-        return item
-    except Exception as e:
+    except SQLAlchemyError:
         raise HTTPException(status_code=500, detail="Internal Server Error")
+    if updated == 0:
+        raise HTTPException(status_code=404, detail="item not found")
+    return {"id": item_id, **values}
 
 # アイテムの削除
+# SELECTせずに条件付きのDELETEを1回発行し、削除件数が0なら404とする
 @router.delete("/items/{item_id}")
 def delete(
     item_id: int,
     session: Session = Depends(get_session),
-    current_user: User = Depends(auth.get_current_user([PermissionType.ITEM_DELETE]))
+    current_user: auth.Principal = Depends(auth.get_current_user([PermissionType.ITEM_DELETE]))
 ):
-    item = session.query(Item).filter(and_(Item.id == item_id, Item.user_id == current_user.id)).first()
-    if item is None:
-        raise HTTPException(status_code=404, detail="item not found")
     try:
-        session.delete(item)
+        deleted = session.query(Item).filter(and_(Item.id == item_id, Item.user_id == current_user.id)) \
+            .delete(synchronize_session=False)
         session.commit()
     except Exception as e:
         raise HTTPException(status_code=500, detail="Internal Server Error")
-    return {"item_id": item_id}
\ No newline at end of file
+    if deleted == 0:
+        raise HTTPException(status_code=404, detail="item not found")
+    return {"item_id": item_id}
+
+
+# バッチAPI
+# 複数のAPI呼び出し (method, path, body) を1回のHTTPリクエストで受け取り、HTTPを経由せずにルーターで順に処理する
+# 認証はバッチAPIで1回だけ行い、サブリクエストではそのPrincipalとバッチのコネクションを共有する
+# 各サブリクエストはセーブポイントで実行し、失敗したサブリクエストの変更はロールバックする
+# atomic=true の場合はすべてのサブリクエストを1つのトランザクションで実行し、失敗した時点で全体をロールバックする
+@router.post("/batch")
+async def batch_requests(
+    request: Request,
+    data: BatchRequestSchema,
+    session: Session = Depends(get_session),
+    current_user: auth.Principal = Depends(auth.get_current_user())
+):
+    batch.check_requests(data.requests)
+    return await batch.run(request, data.requests, current_user, data.atomic, batch.SavepointSessions(session))
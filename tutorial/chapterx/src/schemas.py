@@ -1,5 +1,6 @@
-from typing import Optional, List
-from pydantic import ConfigDict, BaseModel
+from datetime import datetime
+from typing import Any, Optional, List
+from pydantic import ConfigDict, BaseModel, Field, field_validator
 
 class RoleSchema(BaseModel):
     id: int
@@ -36,10 +37,69 @@ class ItemResponseSchema(BaseModel):
 
     model_config = ConfigDict(from_attributes=True)
 
+class ItemListResponseSchema(BaseModel):
+    """アイテム一覧のレスポンス。 fields パラメータで指定した項目だけを返す"""
+    id: int
+    title: Optional[str] = None
+    content: Optional[str] = None
+    created: Optional[datetime] = None
+    updated: Optional[datetime] = None
+
 class ItemPostSchema(BaseModel):
     title: str
     content: str
 
 class ItemPutSchema(BaseModel):
     title: str
-    content: str
\ No newline at end of file
+    content: str
+
+# 複数取得・一括削除で一度に指定できるidの最大数
+MAX_BULK_IDS = 1000
+
+class ItemIdsSchema(BaseModel):
+    """アイテムの複数取得・一括削除のリクエスト"""
+    ids: List[int] = Field(min_length=1, max_length=MAX_BULK_IDS)
+
+class ItemPatchSchema(BaseModel):
+    """アイテムの部分更新。指定した項目だけを更新する (null は指定できない)"""
+    title: Optional[str] = None
+    content: Optional[str] = None
+
+    @field_validator("title", "content")
+    @classmethod
+    def not_null(cls, value: Optional[str]) -> str:
+        # 省略は許可するが、明示的な null は NOT NULL のカラムを更新してしまうため422にする
+        if value is None:
+            raise ValueError("must not be null")
+        return value
+
+class ItemPatchResponseSchema(BaseModel):
+    """アイテムの部分更新のレスポンス。idと更新した項目だけを返す"""
+    id: int
+    title: Optional[str] = None
+    content: Optional[str] = None
+
+class RefreshTokenSchema(BaseModel):
+    refresh_token: str
+
+class LogoutSchema(BaseModel):
+    # 指定された場合はリフレッシュトークンも失効させる
+    refresh_token: Optional[str] = None
+
+class RevokeTokenSchema(BaseModel):
+    jti: str
+
+# バッチAPIで一度に送信できるサブリクエストの最大数
+MAX_BATCH_REQUESTS = 50
+
+class SubRequestSchema(BaseModel):
+    """バッチAPIのサブリクエスト。 path は "/api/v1/items/?limit=10" のようにクエリ文字列を含めてよい"""
+    method: str
+    path: str
+    body: Optional[Any] = None
+
+class BatchRequestSchema(BaseModel):
+    requests: List[SubRequestSchema] = Field(min_length=1, max_length=MAX_BATCH_REQUESTS)
+    # Trueの場合、すべてのサブリクエストを1つのトランザクションで実行し、
+    # 1つでも失敗(ステータス400以上)したらそれまでの変更をロールバックする
+    atomic: bool = False
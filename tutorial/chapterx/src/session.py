@@ -1,19 +1,174 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import functools
+import inspect
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from fastapi import Request
+from fastapi.routing import APIRoute
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 
 from env import Environment
+from pool_stats import InstrumentedQueuePool, InstrumentedAsyncAdaptedQueuePool
+from replica import ReplicaRouter
+import batch
 
 env = Environment()
-SQLALCHEMY_DATABASE_URL = f"mysql+pymysql://{env.db_user}:{env.db_password}@{env.db_host}:{env.db_port}/{env.db_name}?charset=utf8mb4"
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+
+def _database_url(driver: str, host: str, port: str) -> str:
+    return f"mysql+{driver}://{env.db_user}:{env.db_password}@{host}:{port}/{env.db_name}?charset=utf8mb4"
+
+def _replica_addresses() -> List[Tuple[str, str]]:
+    """db_replica_hosts ("host1:port1,host2" 形式) を (host, port) のリストに変換する"""
+    addresses = []
+    for item in env.db_replica_hosts.split(","):
+        if item.strip():
+            host, _, port = item.strip().partition(":")
+            addresses.append((host, port or env.db_port))
+    return addresses
+
+SQLALCHEMY_DATABASE_URL = _database_url("pymysql", env.db_host, env.db_port)
+# コネクションプールの設定: https://docs.sqlalchemy.org/en/20/core/pooling.html
+POOL_OPTIONS = dict(
+    pool_size=env.db_pool_size,
+    max_overflow=env.db_max_overflow,
+    pool_timeout=env.db_pool_timeout,
+    pool_recycle=env.db_pool_recycle,
+    pool_pre_ping=env.db_pool_pre_ping,
+)
+engine = create_engine(SQLALCHEMY_DATABASE_URL, poolclass=InstrumentedQueuePool, **POOL_OPTIONS)
 SessionLocal = sessionmaker(autocommit = False, autoflush = True, bind=engine)
 
-def get_session():
+# 読み取り専用のレプリカ。参照系のリクエストは session_router によってこちらに振り分けられる
+replica_engines = [
+    create_engine(_database_url("pymysql", host, port), poolclass=InstrumentedQueuePool, **POOL_OPTIONS)
+    for host, port in _replica_addresses()
+]
+session_router = ReplicaRouter(
+    SessionLocal,
+    [sessionmaker(autocommit=False, autoflush=True, bind=e) for e in replica_engines],
+    env.db_replica_sticky_seconds,
+)
+
+# 非同期モード (db_async=True) 用のエンジン。ドライバには aiomysql を利用する
+#   https://docs.sqlalchemy.org/en/20/orm/extensions/asyncio.html
+ASYNC_SQLALCHEMY_DATABASE_URL = _database_url("aiomysql", env.db_host, env.db_port)
+async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL, poolclass=InstrumentedAsyncAdaptedQueuePool, **POOL_OPTIONS)
+# expire_on_commit=False : commit後に属性へアクセスしても暗黙のSELECT(非同期では利用できない)が発行されないようにする
+AsyncSessionLocal = async_sessionmaker(autoflush=True, expire_on_commit=False, bind=async_engine)
+
+async_replica_engines = [
+    create_async_engine(_database_url("aiomysql", host, port), poolclass=InstrumentedAsyncAdaptedQueuePool, **POOL_OPTIONS)
+    for host, port in _replica_addresses()
+]
+async_session_router = ReplicaRouter(
+    AsyncSessionLocal,
+    [async_sessionmaker(autoflush=True, expire_on_commit=False, bind=e) for e in async_replica_engines],
+    env.db_replica_sticky_seconds,
+)
+
+# セッションのトランザクション内で書き込み(flush)が行われたかを記録する
+@event.listens_for(Session, "after_flush")
+def _after_flush(session, flush_context):
+    session.info["flushed"] = True
+
+@event.listens_for(Session, "after_transaction_end")
+def _after_transaction_end(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("flushed", None)
+
+def _is_read_only(session: Session) -> bool:
+    return not (session.info.get("flushed") or session.new or session.dirty or session.deleted)
+
+def release_connection(session: Session) -> None:
+    """読み取りだけのトランザクションを終了し、コネクションをプールに返す
+
+    読み込み済みのオブジェクトは期限切れにしないため、レスポンスの変換では再度SELECTされない。
+    コミットされていない書き込みがある場合は何もしない (確定させずに close 時にロールバックさせる)
+    """
+    if not session.in_transaction() or not _is_read_only(session):
+        return
+    expire_on_commit = session.expire_on_commit
+    session.expire_on_commit = False
+    try:
+        session.commit()
+    finally:
+        session.expire_on_commit = expire_on_commit
+
+async def release_async_connection(session: AsyncSession) -> None:
+    """release_connection の非同期版"""
+    if not session.in_transaction() or not _is_read_only(session.sync_session):
+        return
+    expire_on_commit = session.sync_session.expire_on_commit
+    session.sync_session.expire_on_commit = False
+    try:
+        await session.commit()
+    finally:
+        session.sync_session.expire_on_commit = expire_on_commit
+
+class SessionReleasingRoute(APIRoute):
+    """ハンドラが戻った時点で、引数で受け取ったセッションのコネクションをプールに返すルート
+
+    セッションの close は依存関係の後処理 (レスポンスの変換後) まで行われないため、
+    その間コネクションを保持し続けないようにする。
+    コネクションはセッションで最初にSQLを発行したときに取得されるため、
+    キャッシュで認可が済みDBを使わないリクエストではコネクションを取得しない。
+    """
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        super().__init__(path, _releasing_endpoint(endpoint), **kwargs)
+
+def _releasing_endpoint(endpoint: Callable) -> Callable:
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            result = await endpoint(*args, **kwargs)
+            for value in kwargs.values():
+                if isinstance(value, AsyncSession):
+                    await release_async_connection(value)
+            return result
+    else:
+        @functools.wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            result = endpoint(*args, **kwargs)
+            for value in kwargs.values():
+                if isinstance(value, Session):
+                    release_connection(value)
+            return result
+    return wrapper
+
+def routed_session(router: ReplicaRouter, request: Request) -> Iterator[Session]:
+    """router が選んだセッションファクトリーでセッションを生成し、処理後にcloseする"""
+    db = router.select(request)()
+    try:
+        yield db
+    finally:
+        db.close()
+        router.release(request)
+
+def get_batch_session(request: Optional[Request]):
+    """バッチAPIのサブリクエストであれば、バッチ全体で共有するセッションを返す (closeはバッチAPIで行う)"""
+    return None if request is None else request.scope.get(batch.SESSION_KEY)
+
+def get_session(request: Request):
     """DBのセッションを生成する。
     1リクエスト1セッションの想定で、 レスポンスが返却される際に自動でcloseされる。
+    レプリカが設定されている場合、参照系のリクエストはレプリカのセッションになる。
     """
-    db = SessionLocal()
+    shared = get_batch_session(request)
+    if shared is not None:
+        yield shared
+        return
+    yield from routed_session(session_router, request)
+
+async def get_async_session(request: Request):
+    """get_session の非同期版。AsyncSessionを生成する"""
+    shared = get_batch_session(request)
+    if shared is not None:
+        yield shared
+        return
     try:
-        yield db
+        async with async_session_router.select(request)() as db:
+            yield db
     finally:
-        db.close()
\ No newline at end of file
+        async_session_router.release(request)
@@ -2,7 +2,8 @@ from session import get_session
 from sqlalchemy.orm import Session
 from fastapi.testclient import TestClient
 
-from model import User, Role, RoleType
+from model import User, RoleType
+from role_service import get_roles_by_names
 import auth
 
 def create_user(session: Session, username: str, password: str, role_type: RoleType) -> User:
@@ -12,15 +13,13 @@ def create_user(session: Session, username: str, password: str, role_type: RoleT
         raise Exception(f"{username} is already exists.")
 
     # roleの存在確認
-    role = session.query(Role).filter(Role.name == role_type.value).first()
-    if role is None:
-        raise Exception(f"{role_type.value} is not exists.")
+    roles = get_roles_by_names(session, [role_type])
 
     user = User(
         username=username,
         hashed_password=auth.hash(password),
         age=20,
-        roles=[role],
+        roles=roles,
     )
     session.add(user)
     session.commit()
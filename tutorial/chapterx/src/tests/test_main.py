@@ -3,16 +3,59 @@ import pprint
 pprint.pprint(sys.path)
 sys.path.append("/opt/app/api")
 
+import asyncio
+import csv
+import io
+import json
+import logging
 import pytest
+from datetime import datetime, timedelta, UTC
+from jose import jwt
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, insert
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from fastapi import FastAPI, Request
 
-from session import get_session
-from model import Base, RoleType, Role
+from session import get_session, get_async_session, get_batch_session, routed_session, release_connection
+from replica import ReplicaRouter
+from model import Base, RoleType, Role, User, Item, UserRole, RevokedToken
 from main import app
+from async_routers import router as async_router
 from env import Environment
 from tests.lib import create_user, fetch_token
+from permission_service import PermissionService, PermissionType
+from token_codec import JWTCodec, CompactCodec, InvalidTokenError
+import auth
+import routers
+import query_stats
+import item_import
+from pagination import encode_cursor
+from revocation import RevocationList, revoke_token, purge_expired
+from hasher import PasswordHasher, get_rounds
+
+def statements_of(fn):
+    """fn の実行中に発行されたSQLのリストを返す"""
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        fn()
+    finally:
+        event.remove(Engine, "before_cursor_execute", before_cursor_execute)
+    return statements
+
+def create_test_users(session):
+    session.add(Role(id=1, name=RoleType.SYSTEM_ADMIN))
+    session.add(Role(id=2, name=RoleType.LOCATION_ADMIN))
+    session.add(Role(id=3, name=RoleType.LOCATION_OPERATOR))
+    session.commit()
+    create_user(session, "sys_admin"   , "password", RoleType.SYSTEM_ADMIN)
+    create_user(session, "loc_admin"   , "password", RoleType.LOCATION_ADMIN)
+    create_user(session, "loc_operator", "password", RoleType.LOCATION_OPERATOR)
 
 @pytest.fixture
 def client() -> TestClient:
@@ -27,7 +70,12 @@ def client() -> TestClient:
     Base.metadata.create_all(engine)
 
     # DIを使ってFastAPIのDBの向き先をテスト用DBに変更
-    def get_test_session():
+    # テストから直接呼び出す場合は request を省略する
+    def get_test_session(request: Request = None):
+        shared = get_batch_session(request)
+        if shared is not None:
+            yield shared
+            return
         session = TestSessionFactory()
         try:
             yield session
@@ -36,15 +84,14 @@ def client() -> TestClient:
 
     app.dependency_overrides[get_session] = get_test_session
 
+    # テーブルを作り直すので、前のテストでキャッシュされた認証結果を破棄する
+    auth.token_cache.clear()
+    auth.token_versions.clear()
+    auth.revocations.clear()
+
     # テスト用のロールとユーザーを作成
     with TestSessionFactory() as session:
-        session.add(Role(id=1, name=RoleType.SYSTEM_ADMIN))
-        session.add(Role(id=2, name=RoleType.LOCATION_ADMIN))
-        session.add(Role(id=3, name=RoleType.LOCATION_OPERATOR))
-        session.commit()
-        create_user(session, "sys_admin"   , "password", RoleType.SYSTEM_ADMIN)
-        create_user(session, "loc_admin"   , "password", RoleType.LOCATION_ADMIN)
-        create_user(session, "loc_operator", "password", RoleType.LOCATION_OPERATOR)
+        create_test_users(session)
 
     # テスト用のHTTPクライアントを作成
     client = TestClient(app=app)
@@ -55,6 +102,31 @@ def client() -> TestClient:
     # テスト関数実行後の後処理
     client.close()
 
+@pytest.fixture
+def async_client(client) -> TestClient:
+    """非同期モード(async_routers)のAPIを呼び出すクライアント。DBの初期化は client フィクスチャで行う"""
+    env = Environment()
+    DB_URL = f"mysql+aiomysql://{env.db_user}:{env.db_password}@{env.db_host}:{env.db_port}/test?charset=utf8mb4"
+    # TestClientはイベントループを自前で起動するため、コネクションをプールしない
+    engine = create_async_engine(DB_URL, poolclass=NullPool)
+    TestAsyncSessionFactory = async_sessionmaker(autoflush=True, expire_on_commit=False, bind=engine)
+
+    async def get_test_async_session(request: Request):
+        shared = get_batch_session(request)
+        if shared is not None:
+            yield shared
+            return
+        async with TestAsyncSessionFactory() as session:
+            yield session
+
+    async_app = FastAPI()
+    async_app.include_router(async_router, prefix="/api/v1")
+    async_app.dependency_overrides[get_async_session] = get_test_async_session
+
+    async_client = TestClient(app=async_app)
+    yield async_client
+    async_client.close()
+
 
 def test_user_create_sys_admin(client):
     """
@@ -90,6 +162,24 @@ def test_user_create_loc_operator(client):
     )
     assert response.status_code == 403
 
+def test_user_create_missing_roles(client):
+    """
+    存在しないロールを指定すると、見つからないすべてのidを含む404エラーになります
+    """
+    token = fetch_token(client, "sys_admin", "password")
+    response = client.post(
+        "/api/v1/users/",
+        headers={"Authorization": f"Bearer {token}"},
+        json={
+            "username": "test",
+            "password": "password",
+            "age": 30,
+            "role_ids": [1, 98, 99],
+        }
+    )
+    assert response.status_code == 404
+    assert response.json()["detail"] == "Role is not found. (id=98, 99)"
+
 def test_user_get(client):
     token = fetch_token(client, "sys_admin", "password")
     response = client.get(
@@ -100,6 +190,32 @@ def test_user_get(client):
     assert response.status_code == 200
 
 
+def test_user_list_statement_count(client, monkeypatch):
+    """
+    ユーザー一覧で発行されるSQLの件数は、ユーザー数によらず一定です (ロールのN+1が発生しない)
+    """
+    monkeypatch.setattr(auth.hasher, "rounds", 4)
+    token = fetch_token(client, "sys_admin", "password")
+    headers = {"Authorization": f"Bearer {token}"}
+    def count_statements():
+        response = client.get("/api/v1/users/", headers=headers, params={"limit": 100})
+        assert response.status_code == 200
+        assert all(user["roles"] for user in response.json())
+        return len(response.json()), int(response.headers["Server-Timing"].split('desc="')[1].split()[0])
+
+    count_statements()  # 認証結果をキャッシュさせる
+    users, statements = count_statements()
+    assert users == 3
+    assert statements == 2  # users と roles (user_roles) のSELECT
+
+    session = next(app.dependency_overrides[get_session]())
+    try:
+        for i in range(20):
+            create_user(session, f"user{i}", "password", RoleType.LOCATION_OPERATOR)
+    finally:
+        session.close()
+    assert count_statements() == (23, statements)
+
 def test_user_update(client):
     token = fetch_token(client, "sys_admin", "password")
     response = client.put(
@@ -121,6 +237,348 @@ def test_user_delete(client):
     )
     assert response.status_code == 200
 
+def test_user_delete_cascades_in_database(client):
+    """
+    ユーザーの削除では、アイテムやロールの割り当てを読み込まずにDB側で削除します
+    """
+    session = next(app.dependency_overrides[get_session]())
+    try:
+        session.add_all([Item(user_id=3, title=f"title{i}", content="content") for i in range(10)])
+        session.commit()
+    finally:
+        session.close()
+
+    token = fetch_token(client, "sys_admin", "password")
+    statements = statements_of(
+        lambda: client.delete("/api/v1/users/3", headers={"Authorization": f"Bearer {token}"})
+    )
+    assert not any("FROM items" in statement or "FROM user_roles" in statement for statement in statements)
+
+    session = next(app.dependency_overrides[get_session]())
+    try:
+        assert session.query(Item).filter(Item.user_id == 3).count() == 0
+        assert session.query(UserRole).filter(UserRole.user_id == 3).count() == 0
+    finally:
+        session.close()
+
+def test_token_cache_invalidated_on_user_update(client):
+    """
+    ユーザーのロールを更新すると、キャッシュ済みのトークンにも新しい権限が反映されます
+    """
+    token = fetch_token(client, "loc_admin", "password")
+    headers = {"Authorization": f"Bearer {token}"}
+    response = client.get("/api/v1/users/", headers=headers)
+    assert response.status_code == 200
+
+    admin_token = fetch_token(client, "sys_admin", "password")
+    response = client.put(
+        "/api/v1/users/2",
+        headers={"Authorization": f"Bearer {admin_token}"},
+        json={
+            "password": "password",
+            "age": 30,
+            "role_ids": [3],
+        }
+    )
+    assert response.status_code == 200
+
+    response = client.get("/api/v1/users/", headers=headers)
+    assert response.status_code == 403
+
+def test_token_cache_invalidated_on_user_delete(client):
+    """
+    削除されたユーザーのトークンは、キャッシュ済みであっても利用できません
+    """
+    token = fetch_token(client, "loc_operator", "password")
+    headers = {"Authorization": f"Bearer {token}"}
+    response = client.get("/api/v1/items/", headers=headers)
+    assert response.status_code == 200
+
+    admin_token = fetch_token(client, "sys_admin", "password")
+    response = client.delete("/api/v1/users/3", headers={"Authorization": f"Bearer {admin_token}"})
+    assert response.status_code == 200
+
+    response = client.get("/api/v1/items/", headers=headers)
+    assert response.status_code == 401
+
+def test_load_principal_single_query(client):
+    """
+    認証時のユーザーとロールの取得は1回のクエリで行われます
+    """
+    session = next(app.dependency_overrides[get_session]())
+    principal = None
+    def load_principal():
+        nonlocal principal
+        principal = auth.load_principal(session, "loc_admin")
+    try:
+        statements = statements_of(load_principal)
+    finally:
+        session.close()
+    assert len(statements) == 1
+    assert principal.roles == {RoleType.LOCATION_ADMIN}
+
+def test_release_connection(client):
+    """
+    読み取りだけのセッションは、closeする前にコネクションをプールに返せます。
+    読み込み済みのオブジェクトは、そのまま参照できます
+    """
+    session = next(app.dependency_overrides[get_session]())
+    pool = session.get_bind().pool
+    try:
+        user = session.query(User).filter(User.username == "loc_admin").first()
+        assert pool.checkedout() == 1
+        release_connection(session)
+        assert pool.checkedout() == 0
+        assert user.username == "loc_admin"
+        assert pool.checkedout() == 0
+
+        # コミットされていない変更があれば何もしない
+        user.age = 99
+        session.flush()
+        release_connection(session)
+        assert pool.checkedout() == 1
+    finally:
+        session.close()
+    assert pool.checkedout() == 0
+
+def test_stateless_token(client, monkeypatch):
+    """
+    ステートレスモードで発行したトークンは、DBを参照せずに認可されます。
+    ユーザーを更新するとトークンバージョンが上がり、発行済みのトークンは失効します
+    """
+    monkeypatch.setenv("TOKEN_STATELESS", "true")
+    token = fetch_token(client, "loc_admin", "password")
+    headers = {"Authorization": f"Bearer {token}"}
+    response = client.get("/api/v1/users/", headers=headers)
+    assert response.status_code == 200
+
+    # トークンバージョンがキャッシュされていれば、認可でSQLは発行されない
+    auth.token_cache.clear()
+    response = None
+    def get_item():
+        nonlocal response
+        response = client.get("/api/v1/items/999", headers=headers)
+    statements = statements_of(get_item)
+    assert response.status_code == 404
+    assert len(statements) == 1  # アイテムのSELECTのみ
+
+    admin_token = fetch_token(client, "sys_admin", "password")
+    response = client.put(
+        "/api/v1/users/2",
+        headers={"Authorization": f"Bearer {admin_token}"},
+        json={
+            "password": "password",
+            "age": 30,
+            "role_ids": [2],
+        }
+    )
+    assert response.status_code == 200
+
+    response = client.get("/api/v1/users/", headers=headers)
+    assert response.status_code == 401
+
+def test_refresh_token(client):
+    """
+    リフレッシュトークンでアクセストークンを更新できます。使用済みのリフレッシュトークンは利用できません
+    """
+    response = client.post("/api/v1/token", data={"username": "loc_operator", "password": "password"})
+    assert response.status_code == 200
+    refresh_token = response.json()["refresh_token"]
+
+    response = client.post("/api/v1/token/refresh", json={"refresh_token": refresh_token})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["refresh_token"] != refresh_token
+    response = client.get("/api/v1/items/", headers={"Authorization": f"Bearer {body['access_token']}"})
+    assert response.status_code == 200
+
+    # ローテーション済みのトークンは再利用できない
+    response = client.post("/api/v1/token/refresh", json={"refresh_token": refresh_token})
+    assert response.status_code == 401
+
+    # 署名が不正なトークンは拒否される
+    response = client.post("/api/v1/token/refresh", json={"refresh_token": body["refresh_token"] + "x"})
+    assert response.status_code == 401
+
+def test_logout(client):
+    """
+    ログアウトしたトークンは利用できません
+    """
+    token = fetch_token(client, "loc_operator", "password")
+    headers = {"Authorization": f"Bearer {token}"}
+    response = client.get("/api/v1/items/", headers=headers)
+    assert response.status_code == 200
+
+    response = client.post("/api/v1/logout", headers=headers)
+    assert response.status_code == 200
+
+    response = client.get("/api/v1/items/", headers=headers)
+    assert response.status_code == 401
+
+def test_revoke_token(client):
+    """
+    管理者はjtiを指定してトークンを失効させられます。他のワーカーでは差分の読み込みで反映されます
+    """
+    token = fetch_token(client, "loc_operator", "password")
+    headers = {"Authorization": f"Bearer {token}"}
+    response = client.get("/api/v1/items/", headers=headers)
+    assert response.status_code == 200
+    jti = jwt.get_unverified_claims(token)["jti"]
+
+    admin_token = fetch_token(client, "sys_admin", "password")
+    response = client.post(
+        "/api/v1/tokens/revoke",
+        headers={"Authorization": f"Bearer {admin_token}"},
+        json={"jti": jti},
+    )
+    assert response.status_code == 200
+    # 失効済みのjtiを再度失効させてもエラーにならない
+    session = next(app.dependency_overrides[get_session]())
+    try:
+        revoke_token(session, jti, datetime.now())
+        session.commit()
+        assert session.query(RevokedToken).filter(RevokedToken.jti == jti).count() == 1
+    finally:
+        session.close()
+
+    # 別のワーカーを想定し、プロセス内の失効リストを空にしてから差分を読み込ませる
+    auth.revocations.clear()
+    response = client.get("/api/v1/items/", headers=headers)
+    assert response.status_code == 401
+
+def test_revocation_reload_and_rebuild(client):
+    """
+    差分の読み込みは作成時刻の範囲で行い、後からコミットされた行も読み込みます。
+    作り直したBloomフィルタには有効期限切れ(削除済み)のjtiは含まれません
+    """
+    revocations = RevocationList(
+        bloom_bits=1 << 10, bloom_hashes=3, recent_size=10,
+        reload_interval=0, reload_overlap=60, rebuild_interval=3600,
+    )
+    session = next(app.dependency_overrides[get_session]())
+    try:
+        revocations.reload_if_due(session)
+        now = datetime.now()
+        # 前回の読み込みより前に作成され、後からコミットされた行
+        session.add(RevokedToken(jti="late", expires=now + timedelta(minutes=5), created=now - timedelta(seconds=10)))
+        session.add(RevokedToken(jti="expired", expires=now - timedelta(minutes=5)))
+        session.commit()
+        revocations.reload_if_due(session)
+        assert revocations.is_revoked(session, "late")
+        assert "expired" in revocations._bloom
+
+        assert purge_expired(session) == 1
+        session.commit()
+        revocations._next_rebuild = 0.0
+        revocations.reload_if_due(session)
+        assert "expired" not in revocations._bloom
+        assert revocations.is_revoked(session, "late")
+    finally:
+        session.close()
+
+@pytest.mark.parametrize("codec_class", [JWTCodec, CompactCodec])
+def test_token_codec_key_rotation(codec_class):
+    """
+    鍵をローテーションしても、古い鍵が残っていれば発行済みのトークンを検証できます
+    """
+    claims = {"sub": "sys_admin", "exp": datetime.now(UTC) + timedelta(minutes=5)}
+    old_codec = codec_class({"k1": "secret1"}, "k1")
+    new_codec = codec_class({"k1": "secret1", "k2": "secret2"}, "k2")
+    assert new_codec.decode(old_codec.encode(claims))["sub"] == "sys_admin"
+    assert new_codec.decode(new_codec.encode(claims))["sub"] == "sys_admin"
+
+    # 知らない鍵・改ざん・期限切れのトークンは拒否される
+    with pytest.raises(InvalidTokenError):
+        old_codec.decode(new_codec.encode(claims))
+    with pytest.raises(InvalidTokenError):
+        codec_class({"k1": "other"}, "k1").decode(old_codec.encode(claims))
+    with pytest.raises(InvalidTokenError):
+        old_codec.decode(old_codec.encode({**claims, "exp": datetime.now(UTC) - timedelta(minutes=5)}))
+
+def test_compact_token(client, monkeypatch):
+    """
+    compact形式のトークンでもAPIを利用できます
+    """
+    monkeypatch.setattr(auth, "token_codec", CompactCodec({"default": "1234567890"}, "default"))
+    token = fetch_token(client, "sys_admin", "password")
+    response = client.get("/api/v1/users/", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+
+def test_permission_mask():
+    """
+    ロールの組み合わせのビットマスクは、各ロールが持つ権限の和になります
+    """
+    role_permissions = {
+        RoleType.SYSTEM_ADMIN: set(PermissionType),
+        RoleType.LOCATION_ADMIN: {
+            PermissionType.USER_READ, PermissionType.USER_UPDATE,
+            PermissionType.ITEM_CREATE, PermissionType.ITEM_READ, PermissionType.ITEM_UPDATE, PermissionType.ITEM_DELETE,
+        },
+        RoleType.LOCATION_OPERATOR: {
+            PermissionType.ITEM_CREATE, PermissionType.ITEM_READ, PermissionType.ITEM_UPDATE, PermissionType.ITEM_DELETE,
+        },
+    }
+    for role_bits in range(1 << len(RoleType)):
+        roles = frozenset(r for i, r in enumerate(RoleType) if role_bits & (1 << i))
+        expected = set().union(*(role_permissions[role] for role in roles))
+        role_mask = PermissionService.get_role_mask(roles)
+        assert PermissionService.get_mask_permissions(role_mask) == expected
+        for permission in PermissionType:
+            required = [permission, PermissionType.ITEM_READ]
+            assert PermissionService.has_mask(role_mask, PermissionService.permission_mask(required)) \
+                == set(required).issubset(expected)
+
+def test_token_hashing_overloaded(client, monkeypatch):
+    """
+    パスワードハッシュ計算の待ち行列が満杯の場合は、503とRetry-Afterを返します
+    """
+    monkeypatch.setattr(auth, "hasher", PasswordHasher(workers=1, max_pending=0, retry_after=3))
+    response = client.post(
+        "/api/v1/token",
+        data={"username": "sys_admin", "password": "password"}
+    )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "3"
+
+def test_hasher_recovers_from_broken_pool():
+    """
+    ハッシュ計算の子プロセスが異常終了しても、プールを作り直して計算を続けます
+    """
+    hasher = PasswordHasher(workers=1, max_pending=2, rounds=4)
+    hashed_password = hasher.hash("password")
+    for process in list(hasher._executor._processes.values()):
+        process.kill()
+        process.join()
+    assert hasher.verify("password", hashed_password)
+    hasher._executor.shutdown()
+
+def test_token_rehash_on_login(client, monkeypatch):
+    """
+    保存されているハッシュのコストが設定値と異なる場合は、ログイン時に再計算されます
+    """
+    monkeypatch.setattr(auth.hasher, "rounds", 4)
+    fetch_token(client, "sys_admin", "password")
+
+    session = next(app.dependency_overrides[get_session]())
+    user = session.query(User).filter(User.username == "sys_admin").first()
+    assert get_rounds(user.hashed_password) == 4
+    session.close()
+
+    # 再計算後のハッシュでもログインできる
+    fetch_token(client, "sys_admin", "password")
+
+def test_internal_stats(client):
+    response = client.get("/internal/stats")
+    assert response.status_code == 401
+    token = fetch_token(client, "loc_admin", "password")
+    response = client.get("/internal/stats", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 403
+    token = fetch_token(client, "sys_admin", "password")
+    response = client.get("/internal/stats", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+    assert response.json()["hashing"]["completed"] > 0
+    assert "checked_out" in response.json()["db_pool"]
+
 def test_item_post(client):
     token = fetch_token(client, "sys_admin", "password")
     response = client.post(
@@ -142,6 +600,363 @@ def test_item_getAll(client):
     )
     assert response.status_code == 200
 
+def test_item_create_does_not_load_items(client):
+    """
+    アイテムの作成では、ユーザーの既存のアイテムを読み込みません
+    """
+    token = fetch_token(client, "loc_operator", "password")
+    headers = {"Authorization": f"Bearer {token}"}
+    for i in range(3):
+        response = client.post("/api/v1/items/", headers=headers, json={"title": f"title{i}", "content": "content"})
+        assert response.status_code == 200
+    assert "WHERE items.user_id" not in " ".join(statements_of(
+        lambda: client.post("/api/v1/items/", headers=headers, json={"title": "title", "content": "content"})
+    ))
+
+    # write_only のリレーションからも追加・取得できる
+    session = next(app.dependency_overrides[get_session]())
+    try:
+        user = session.query(User).filter(User.username == "loc_operator").first()
+        user.items.add(Item(title="added", content="content"))
+        session.commit()
+        assert len(session.scalars(user.items.select()).all()) == 5
+    finally:
+        session.close()
+
+def test_item_list_fields(client):
+    """
+    fields / summary を指定すると、指定した項目だけを返し、content はSELECTしません
+    """
+    token = fetch_token(client, "loc_operator", "password")
+    headers = {"Authorization": f"Bearer {token}"}
+    response = client.post("/api/v1/items/", headers=headers, json={"title": "タイトル", "content": "本文"})
+    id = response.json()["id"]
+
+    response = None
+    def get_summary():
+        nonlocal response
+        response = client.get("/api/v1/items/", headers=headers, params={"summary": True})
+    statements = statements_of(get_summary)
+    assert response.status_code == 200
+    assert list(response.json()[0].keys()) == ["id", "title", "updated"]
+    assert not any("items.content" in statement for statement in statements)
+
+    response = client.get("/api/v1/items/", headers=headers, params={"fields": "title"})
+    assert response.json() == [{"id": id, "title": "タイトル"}]
+    response = client.get("/api/v1/items/", headers=headers)
+    assert response.json() == [{"id": id, "title": "タイトル", "content": "本文"}]
+    response = client.get("/api/v1/items/", headers=headers, params={"fields": "title,hashed_password"})
+    assert response.status_code == 400
+
+    # ユーザー一覧ではパスワードハッシュを読み込まない
+    admin_token = fetch_token(client, "sys_admin", "password")
+    statements = statements_of(lambda: client.get("/api/v1/users/", headers={"Authorization": f"Bearer {admin_token}"}))
+    assert not any("hashed_password" in statement for statement in statements)
+
+def test_item_export(client, caplog):
+    """
+    アイテム・ユーザーを NDJSON / CSV でエクスポートできます。送信中のSQLは送信の完了時にログに出力されます
+    """
+    token = fetch_token(client, "loc_operator", "password")
+    headers = {"Authorization": f"Bearer {token}"}
+    for i in range(3):
+        client.post("/api/v1/items/", headers=headers, json={"title": f"title{i}", "content": f"content,{i}"})
+
+    with caplog.at_level(logging.INFO, logger="query_stats"):
+        response = client.get("/api/v1/items/export", headers=headers, params={"fields": "title,content"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["title"] for line in lines] == ["title0", "title1", "title2"]
+    assert lines[0]["content"] == "content,0"
+    records = [json.loads(r.getMessage()) for r in caplog.records if '"stream"' in r.getMessage()]
+    assert [(r["stream"], r["rows"], r["db_statements"]) for r in records] == [("items", 3, 1)]
+
+    response = client.get("/api/v1/items/export", headers=headers, params={"format": "csv", "fields": "title,content"})
+    assert response.status_code == 200
+    rows = list(csv.reader(io.StringIO(response.text)))
+    assert rows[0] == ["id", "title", "content"]
+    assert [row[2] for row in rows[1:]] == ["content,0", "content,1", "content,2"]
+
+    response = client.get("/api/v1/items/export", headers=headers, params={"format": "xml"})
+    assert response.status_code == 400
+
+    admin_token = fetch_token(client, "sys_admin", "password")
+    response = client.get("/api/v1/users/export", headers={"Authorization": f"Bearer {admin_token}"})
+    assert [json.loads(line)["username"] for line in response.text.splitlines()] == ["sys_admin", "loc_admin", "loc_operator"]
+
+def test_item_import(client, monkeypatch):
+    """
+    NDJSON / CSV でアイテムを一括登録できます。不正な行は行番号とともに返され、残りの行は登録されます
+    """
+    monkeypatch.setattr(item_import._env, "import_batch_size", 2)
+    token = fetch_token(client, "loc_operator", "password")
+    headers = {"Authorization": f"Bearer {token}"}
+    body = "\n".join([
+        json.dumps({"title": "title1", "content": "content1"}),
+        json.dumps({"title": "title2"}),
+        "{invalid",
+        json.dumps({"title": "title3", "content": "content3"}),
+        json.dumps({"title": "title4", "content": "content4"}),
+        json.dumps({"title": "x" * 256, "content": "content5"}),
+    ]).encode("utf-8")
+    def chunks():
+        # ボディを小さなチャンクに分けて送信する
+        for i in range(0, len(body), 7):
+            yield body[i:i + 7]
+    response = client.post("/api/v1/items/import", headers=headers, content=chunks())
+    assert response.status_code == 200
+    result = response.json()
+    assert result["inserted"] == 3
+    assert [error["line"] for error in result["errors"]] == [2, 3, 6]
+
+    response = client.post(
+        "/api/v1/items/import",
+        headers=headers,
+        params={"format": "csv"},
+        content='title,content\ncsv1,"multi\nline"\ncsv2\n',
+    )
+    assert response.json() == {
+        "inserted": 1,
+        "error_count": 1,
+        "errors": [{"line": 4, "detail": "Expected 2 columns, got 1."}],
+    }
+
+    response = client.get("/api/v1/items/", headers=headers, params={"fields": "title,content"})
+    assert [(item["title"], item["content"]) for item in response.json()] == [
+        ("title1", "content1"),
+        ("title3", "content3"),
+        ("title4", "content4"),
+        ("csv1", "multi\nline"),
+    ]
+
+def test_item_import_line_length(client, monkeypatch):
+    """
+    最大文字数を超えた行は、行の途中でチャンクが分かれていてもエラーになり、次の行から読み込みを続けます
+    """
+    monkeypatch.setattr(item_import._env, "import_max_line_length", 50)
+    token = fetch_token(client, "loc_operator", "password")
+    headers = {"Authorization": f"Bearer {token}"}
+    body = "\n".join([
+        json.dumps({"title": "title1", "content": "x" * 100}),
+        json.dumps({"title": "title2", "content": "content2"}),
+    ]).encode("utf-8")
+    def chunks():
+        for i in range(0, len(body), 7):
+            yield body[i:i + 7]
+    response = client.post("/api/v1/items/import", headers=headers, content=chunks())
+    assert response.json() == {
+        "inserted": 1,
+        "error_count": 1,
+        "errors": [{"line": 1, "detail": "Line exceeds 50 characters."}],
+    }
+
+    response = client.post(
+        "/api/v1/items/import",
+        headers=headers,
+        params={"format": "csv"},
+        content=f'title,content\ncsv1,"{"x" * 30}\n{"x" * 30}"\ncsv2,content\n',
+    )
+    assert response.json() == {
+        "inserted": 1,
+        "error_count": 1,
+        "errors": [{"line": 2, "detail": "Line exceeds 50 characters."}],
+    }
+
+def test_item_import_batch_bytes(monkeypatch):
+    """
+    値の合計バイト数が上限を超えた場合は、件数に達していなくてもバッチを登録します
+    """
+    monkeypatch.setattr(item_import._env, "import_batch_size", 1000)
+    monkeypatch.setattr(item_import._env, "import_batch_max_bytes", 200)
+    batches = []
+    async def insert_rows(rows, result):
+        batches.append([number for number, _ in rows])
+    async def chunks():
+        for i in range(5):
+            yield (json.dumps({"title": f"title{i}", "content": "あ" * 40}) + "\n").encode("utf-8")
+    asyncio.run(item_import.import_items(chunks(), "ndjson", 1, insert_rows))
+    # 1行あたり 6 + 120 バイト
+    assert batches == [[1, 2], [3, 4], [5]]
+
+def test_item_import_batch_fallback(client):
+    """
+    バッチの登録に失敗した場合は1行ずつ登録し直し、失敗した行だけをエラーにします
+    """
+    result = item_import.ImportResult(max_errors=10)
+    session = next(app.dependency_overrides[get_session]())
+    commits = []
+    def count_commit(conn):
+        commits.append(conn)
+    event.listen(session.get_bind(), "commit", count_commit)
+    try:
+        item_import.insert_batch(session, [
+            (1, {"user_id": 3, "title": "title1", "content": "content1"}),
+            (2, {"user_id": 3, "title": None, "content": "content2"}),
+            (3, {"user_id": 3, "title": "title3", "content": "content3"}),
+        ], result)
+        assert session.query(Item).filter(Item.user_id == 3).count() == 2
+    finally:
+        event.remove(session.get_bind(), "commit", count_commit)
+        session.close()
+    assert result.inserted == 2
+    assert [error["line"] for error in result.errors] == [2]
+    # エラーの行があってもコミットは1回
+    assert len(commits) == 1
+
+def test_item_bulk_get_and_delete(client):
+    """
+    複数のアイテムをまとめて取得・削除できます。他のユーザーのアイテムは対象になりません
+    """
+    token = fetch_token(client, "loc_operator", "password")
+    headers = {"Authorization": f"Bearer {token}"}
+    ids = [
+        client.post("/api/v1/items/", headers=headers, json={"title": f"title{i}", "content": "content"}).json()["id"]
+        for i in range(4)
+    ]
+    admin_token = fetch_token(client, "sys_admin", "password")
+    admin_headers = {"Authorization": f"Bearer {admin_token}"}
+    other_id = client.post("/api/v1/items/", headers=admin_headers, json={"title": "other", "content": "content"}).json()["id"]
+
+    response = client.get("/api/v1/items/", headers=headers, params={"ids": [ids[2], ids[0], other_id], "fields": "title"})
+    assert response.json() == [{"id": ids[0], "title": "title0"}, {"id": ids[2], "title": "title2"}]
+    response = client.post("/api/v1/items/bulk-get", headers=headers, json={"ids": [ids[1], other_id]})
+    assert response.json() == [{"id": ids[1], "title": "title1", "content": "content"}]
+    response = client.post("/api/v1/items/bulk-get", headers=headers, json={"ids": []})
+    assert response.status_code == 422
+
+    statements = []
+    def bulk_delete():
+        statements.append(client.post("/api/v1/items/bulk-delete", headers=headers, json={"ids": ids[:3] + [other_id]}))
+    item_statements = [s for s in statements_of(bulk_delete) if "items" in s]
+    assert statements[0].json() == {"deleted": 3}
+    assert [s.split()[0] for s in item_statements] == ["DELETE"]
+
+    response = client.get("/api/v1/items/", headers=headers)
+    assert [item["id"] for item in response.json()] == [ids[3]]
+    response = client.get(f"/api/v1/items/{other_id}", headers=admin_headers)
+    assert response.status_code == 200
+
+def test_batch_isolates_failed_sub_request(client, monkeypatch):
+    """
+    バッチ内でflush後に例外になったサブリクエストの変更は、後続のサブリクエストと一緒にコミットされません
+    """
+    def failing_insert_batch(session, rows, result):
+        session.execute(insert(Item), [values for _, values in rows])
+        raise RuntimeError("failed after flush")
+    monkeypatch.setattr(routers, "insert_batch", failing_insert_batch)
+    token = fetch_token(client, "loc_operator", "password")
+    headers = {"Authorization": f"Bearer {token}"}
+    response = client.post("/api/v1/batch", headers=headers, json={"requests": [
+        {"method": "POST", "path": "/api/v1/items/import", "body": {"title": "imported", "content": "content"}},
+        {"method": "POST", "path": "/api/v1/items/", "body": {"title": "created", "content": "content"}},
+    ]})
+    assert [result["status"] for result in response.json()["results"]] == [500, 200]
+    response = client.get("/api/v1/items/", headers=headers)
+    assert [item["title"] for item in response.json()] == ["created"]
+
+def test_batch(client):
+    """
+    複数のAPI呼び出しをバッチAPIでまとめて実行できます。atomic=true の場合は失敗すると全体がロールバックされます
+    """
+    token = fetch_token(client, "loc_operator", "password")
+    headers = {"Authorization": f"Bearer {token}"}
+    response = client.post("/api/v1/batch", headers=headers, json={"requests": [
+        {"method": "POST", "path": "/api/v1/items/", "body": {"title": "title1", "content": "content1"}},
+        {"method": "GET", "path": "/api/v1/items/?fields=title"},
+        {"method": "GET", "path": "/api/v1/users/"},
+    ]})
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["status"] for result in results] == [200, 200, 403]
+    id = results[0]["body"]["id"]
+    assert results[1]["body"] == [{"id": id, "title": "title1"}]
+
+    # atomic でない場合、失敗した書き込みの後のサブリクエストは影響を受けずにコミットされる
+    response = client.post("/api/v1/batch", headers=headers, json={"requests": [
+        {"method": "PUT", "path": f"/api/v1/items/{id + 100}", "body": {"title": "title5", "content": "content5"}},
+        {"method": "POST", "path": "/api/v1/items/", "body": {"title": None, "content": "content5"}},
+        {"method": "POST", "path": "/api/v1/items/", "body": {"title": "title5", "content": "content5"}},
+    ]})
+    assert [result["status"] for result in response.json()["results"]] == [404, 422, 200]
+    id5 = response.json()["results"][2]["body"]["id"]
+    response = client.delete(f"/api/v1/items/{id5}", headers=headers)
+    assert response.status_code == 200
+
+    response = client.post("/api/v1/batch", headers=headers, json={"atomic": True, "requests": [
+        {"method": "POST", "path": "/api/v1/items/", "body": {"title": "title2", "content": "content2"}},
+        {"method": "DELETE", "path": f"/api/v1/items/{id}"},
+        {"method": "GET", "path": f"/api/v1/items/{id + 100}"},
+        {"method": "POST", "path": "/api/v1/items/", "body": {"title": "title3", "content": "content3"}},
+    ]})
+    assert response.json()["committed"] is False
+    assert [result["status"] for result in response.json()["results"]] == [200, 200, 404]
+    response = client.get("/api/v1/items/", headers=headers)
+    assert [item["title"] for item in response.json()] == ["title1"]
+
+    response = client.post("/api/v1/batch", headers=headers, json={"atomic": True, "requests": [
+        {"method": "PATCH", "path": f"/api/v1/items/{id}", "body": {"title": "title4"}},
+        {"method": "GET", "path": f"/api/v1/items/{id}"},
+    ]})
+    assert response.json()["committed"] is True
+    assert response.json()["results"][1]["body"]["title"] == "title4"
+
+    # ストリーミングのレスポンスも、送信が完了するまで受け取る
+    response = client.post("/api/v1/batch", headers=headers, json={"requests": [
+        {"method": "GET", "path": "/api/v1/items/export?fields=title"},
+    ]})
+    result = response.json()["results"][0]
+    assert result["status"] == 200
+    assert [json.loads(line) for line in result["body"].splitlines()] == [{"id": id, "title": "title4"}]
+
+    for path in ("/api/v1/batch", "/internal/stats"):
+        response = client.post("/api/v1/batch", headers=headers, json={"requests": [{"method": "GET", "path": path}]})
+        assert response.status_code == 400
+    response = client.post("/api/v1/batch", json={"requests": [{"method": "GET", "path": "/api/v1/items/"}]})
+    assert response.status_code == 401
+
+def test_item_cursor_pagination(client):
+    """
+    X-Next-Cursor ヘッダのカーソルを指定すると、続きのアイテムを取得できます
+    """
+    token = fetch_token(client, "loc_operator", "password")
+    headers = {"Authorization": f"Bearer {token}"}
+    for i in range(5):
+        response = client.post("/api/v1/items/", headers=headers, json={"title": f"title{i}", "content": "content"})
+        assert response.status_code == 200
+
+    titles = []
+    cursor = None
+    while True:
+        params = {"limit": 2} if cursor is None else {"limit": 2, "cursor": cursor}
+        response = client.get("/api/v1/items/", headers=headers, params=params)
+        assert response.status_code == 200
+        titles += [item["title"] for item in response.json()]
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert titles == [f"title{i}" for i in range(5)]
+
+    # 他のユーザーのカーソルや不正なカーソルは400エラー
+    other_token = fetch_token(client, "loc_admin", "password")
+    response = client.get(
+        "/api/v1/items/", headers={"Authorization": f"Bearer {other_token}"}, params={"cursor": encode_cursor(3, 1)}
+    )
+    assert response.status_code == 400
+    response = client.get("/api/v1/items/", headers=headers, params={"cursor": "invalid"})
+    assert response.status_code == 400
+
+def test_user_cursor_pagination(client):
+    token = fetch_token(client, "sys_admin", "password")
+    headers = {"Authorization": f"Bearer {token}"}
+    response = client.get("/api/v1/users/", headers=headers, params={"limit": 2})
+    assert [user["username"] for user in response.json()] == ["sys_admin", "loc_admin"]
+    response = client.get(
+        "/api/v1/users/", headers=headers, params={"limit": 2, "cursor": response.headers["X-Next-Cursor"]}
+    )
+    assert [user["username"] for user in response.json()] == ["loc_operator"]
+    assert "X-Next-Cursor" not in response.headers
+
 def test_item_get(client):
     token = fetch_token(client, "sys_admin", "password")
     response = client.post(
@@ -196,3 +1011,207 @@ def test_item_delete(client):
         headers={"Authorization": f"Bearer {token}"},
     )
     assert response.status_code == 200
+
+def test_item_patch(client):
+    """
+    PATCHでは指定した項目だけを更新します。更新・削除は1回のSQLで行われます
+    """
+    token = fetch_token(client, "loc_operator", "password")
+    headers = {"Authorization": f"Bearer {token}"}
+    response = client.post("/api/v1/items/", headers=headers, json={"title": "タイトル", "content": "本文"})
+    id = response.json()["id"]
+
+    response = None
+    def patch():
+        nonlocal response
+        response = client.patch(f"/api/v1/items/{id}", headers=headers, json={"title": "タイトル1"})
+    statements = statements_of(patch)
+    assert response.status_code == 200
+    assert response.json() == {"id": id, "title": "タイトル1"}
+    assert [s.split()[0] for s in statements if "items" in s] == ["UPDATE"]
+
+    response = client.get(f"/api/v1/items/{id}", headers=headers)
+    assert response.json() == {"id": id, "title": "タイトル1", "content": "本文"}
+
+    # 他のユーザーのアイテムは更新・削除できない
+    other_token = fetch_token(client, "loc_admin", "password")
+    other_headers = {"Authorization": f"Bearer {other_token}"}
+    response = client.patch(f"/api/v1/items/{id}", headers=other_headers, json={"content": "x"})
+    assert response.status_code == 404
+    response = client.put(f"/api/v1/items/{id}", headers=other_headers, json={"title": "x", "content": "x"})
+    assert response.status_code == 404
+    response = client.delete(f"/api/v1/items/{id}", headers=other_headers)
+    assert response.status_code == 404
+    response = client.patch(f"/api/v1/items/{id}", headers=headers, json={})
+    assert response.status_code == 400
+    # null は指定できない (NOT NULL のカラムを更新しない)
+    for field in ("title", "content"):
+        response = client.patch(f"/api/v1/items/{id}", headers=headers, json={field: None})
+        assert response.status_code == 422
+    response = client.get(f"/api/v1/items/{id}", headers=headers)
+    assert response.json() == {"id": id, "title": "タイトル1", "content": "本文"}
+
+def test_query_stats_server_timing(client):
+    """
+    レスポンスの Server-Timing ヘッダに、リクエスト中に発行したSQLの件数と時間が出力されます
+    """
+    token = fetch_token(client, "sys_admin", "password")
+    response = client.get("/api/v1/users/", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+    timing = response.headers["Server-Timing"]
+    assert timing.startswith("db;dur=")
+    assert int(timing.split('desc="')[1].split()[0]) > 0
+
+def test_query_stats_n_plus_one():
+    """
+    同じ形のSQLが閾値を超えて発行されるとN+1として検出され、遅いSQLは呼び出し元とともに記録されます
+    """
+    stats = query_stats.QueryStats(slow_query_ms=50, n_plus_one_threshold=2)
+    for role_id in range(3):
+        stats.record("SELECT * FROM roles WHERE roles.id = %(pk_1)s", {"pk_1": role_id}, 1.0)
+    stats.record("SELECT * FROM users WHERE users.id IN (%s, %s)", (1, 2), 60.0)
+    stats.record("SELECT * FROM users WHERE users.id IN (%s)", (1,), 1.0)
+
+    assert stats.count == 5
+    assert stats.n_plus_one() == {"SELECT * FROM roles WHERE roles.id = %(pk_1)s": 3}
+    assert stats.slowest[0]["ms"] == 60.0
+    assert len(stats.slow_queries) == 1
+    assert stats.slow_queries[0]["parameters"] == "(1, 2)"
+    assert "test_main.py" in stats.slow_queries[0]["call_site"]
+
+def test_replica_routing(client):
+    """
+    参照系のリクエストはレプリカで処理されます。
+    書き込みを行ったクライアントの参照は、一定時間プライマリで処理されます
+    """
+    # プライマリ(test)とは別のDB(test_replica)をレプリカとして用意する。
+    # ユーザーは両方に作成するが、アイテムはレプリカに反映されない
+    env = Environment()
+    def session_factory(db_name):
+        DB_URL = f"mysql+pymysql://{env.db_user}:{env.db_password}@{env.db_host}:{env.db_port}/{db_name}?charset=utf8mb4"
+        return sessionmaker(autocommit=False, autoflush=True, bind=create_engine(DB_URL))
+    PrimarySessionFactory = session_factory("test")
+    ReplicaSessionFactory = session_factory("test_replica")
+    try:
+        Base.metadata.drop_all(ReplicaSessionFactory.kw["bind"])
+        Base.metadata.create_all(ReplicaSessionFactory.kw["bind"])
+        with ReplicaSessionFactory() as session:
+            create_test_users(session)
+
+        router = ReplicaRouter(PrimarySessionFactory, [ReplicaSessionFactory], sticky_seconds=60)
+        def get_routed_session(request: Request):
+            yield from routed_session(router, request)
+        app.dependency_overrides[get_session] = get_routed_session
+
+        token = fetch_token(client, "loc_operator", "password")
+        headers = {"Authorization": f"Bearer {token}"}
+        response = client.post("/api/v1/items/", headers=headers, json={"title": "title", "content": "content"})
+        assert response.status_code == 200
+        item_id = response.json()["id"]
+
+        # 書き込んだ直後はプライマリから読む
+        response = client.get(f"/api/v1/items/{item_id}", headers=headers)
+        assert response.status_code == 200
+
+        # スティッキー期間を過ぎるとレプリカから読む
+        router.sticky.clear()
+        response = client.get(f"/api/v1/items/{item_id}", headers=headers)
+        assert response.status_code == 404
+    finally:
+        PrimarySessionFactory.kw["bind"].dispose()
+        ReplicaSessionFactory.kw["bind"].dispose()
+
+def test_async_user_crud(async_client):
+    """
+    非同期モードでもユーザーのCRUDができます
+    """
+    token = fetch_token(async_client, "sys_admin", "password")
+    headers = {"Authorization": f"Bearer {token}"}
+    response = async_client.post(
+        "/api/v1/users/",
+        headers=headers,
+        json={"username": "test", "password": "password", "age": 30, "role_ids": [2, 3]},
+    )
+    assert response.status_code == 200
+    user_id = response.json()["id"]
+    assert {r["id"] for r in response.json()["roles"]} == {2, 3}
+
+    response = async_client.get("/api/v1/users/", headers=headers)
+    assert response.status_code == 200
+    assert len(response.json()) == 4
+
+    response = async_client.put(
+        f"/api/v1/users/{user_id}",
+        headers=headers,
+        json={"password": "password", "age": 31, "role_ids": [3]},
+    )
+    assert response.status_code == 200
+    assert response.json()["age"] == 31
+
+    response = async_client.delete(f"/api/v1/users/{user_id}", headers=headers)
+    assert response.status_code == 200
+    response = async_client.get(f"/api/v1/users/{user_id}", headers=headers)
+    assert response.status_code == 404
+
+def test_async_item_crud(async_client, caplog):
+    """
+    非同期モードでもアイテムのCRUDができます
+    """
+    token = fetch_token(async_client, "loc_operator", "password")
+    headers = {"Authorization": f"Bearer {token}"}
+    response = async_client.post("/api/v1/items/", headers=headers, json={"title": "タイトル", "content": "本文"})
+    assert response.status_code == 200
+    id = response.json()["id"]
+
+    response = async_client.get("/api/v1/items/", headers=headers)
+    assert response.status_code == 200
+    assert len(response.json()) == 1
+
+    response = async_client.put(f"/api/v1/items/{id}", headers=headers, json={"title": "タイトル1", "content": "本文2"})
+    assert response.status_code == 200
+    assert response.json()["title"] == "タイトル1"
+
+    response = async_client.patch(f"/api/v1/items/{id}", headers=headers, json={"content": "本文3"})
+    assert response.json() == {"id": id, "content": "本文3"}
+    for field in ("title", "content"):
+        response = async_client.patch(f"/api/v1/items/{id}", headers=headers, json={field: None})
+        assert response.status_code == 422
+    response = async_client.get(f"/api/v1/items/{id}", headers=headers)
+    assert response.json() == {"id": id, "title": "タイトル1", "content": "本文3"}
+
+    with caplog.at_level(logging.INFO, logger="query_stats"):
+        response = async_client.get("/api/v1/items/export", headers=headers, params={"format": "csv"})
+    assert response.status_code == 200
+    assert response.text.splitlines()[1].startswith(f"{id},タイトル1,")
+    records = [json.loads(r.getMessage()) for r in caplog.records if '"stream"' in r.getMessage()]
+    assert [(r["stream"], r["rows"], r["db_statements"]) for r in records] == [("items", 1, 1)]
+
+    response = async_client.get("/api/v1/items/", headers=headers, params={"ids": [id], "summary": True})
+    assert [item["title"] for item in response.json()] == ["タイトル1"]
+    response = async_client.post("/api/v1/items/bulk-get", headers=headers, json={"ids": [id]})
+    assert response.json() == [{"id": id, "title": "タイトル1", "content": "本文3"}]
+
+    response = async_client.delete(f"/api/v1/items/{id}", headers=headers)
+    assert response.status_code == 200
+    response = async_client.get(f"/api/v1/items/{id}", headers=headers)
+    assert response.status_code == 404
+    response = async_client.post("/api/v1/items/bulk-delete", headers=headers, json={"ids": [id]})
+    assert response.json() == {"deleted": 0}
+
+    response = async_client.post("/api/v1/batch", headers=headers, json={"atomic": True, "requests": [
+        {"method": "POST", "path": "/api/v1/items/", "body": {"title": "タイトル", "content": "本文"}},
+        {"method": "GET", "path": f"/api/v1/items/{id + 100}"},
+    ]})
+    assert response.json()["committed"] is False
+    assert [result["status"] for result in response.json()["results"]] == [200, 404]
+    response = async_client.post("/api/v1/batch", headers=headers, json={"requests": [
+        {"method": "POST", "path": "/api/v1/items/", "body": {"title": "タイトル", "content": "本文"}},
+        {"method": "GET", "path": "/api/v1/items/"},
+    ]})
+    assert [result["status"] for result in response.json()["results"]] == [200, 200]
+    assert len(response.json()["results"][1]["body"]) == 1
+    response = async_client.post("/api/v1/batch", headers=headers, json={"requests": [
+        {"method": "GET", "path": "/api/v1/items/export?fields=title"},
+    ]})
+    assert [json.loads(line)["title"] for line in response.json()["results"][0]["body"].splitlines()] == ["タイトル"]
+
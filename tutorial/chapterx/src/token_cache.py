@@ -0,0 +1,111 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Set, Tuple
+
+
+class TokenCache:
+    """検証済みトークンをキーに、認証結果をプロセス内に保持するLRUキャッシュ
+
+    - maxsize 件を超えると最も古く参照されたエントリから破棄する
+    - 各エントリは登録時に指定された expires_at (UNIX時間) を過ぎると無効になる
+    - user_id ごとにエントリを破棄できる (ユーザーの更新・削除時に利用)
+    """
+
+    def __init__(self, maxsize: int, ttl: int):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # token -> (expires_at, user_id, value)
+        self._entries: "OrderedDict[str, Tuple[float, int, Any]]" = OrderedDict()
+        # user_id -> そのユーザーのトークン一覧
+        self._tokens_by_user: Dict[int, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> Optional[Any]:
+        """キャッシュされた値を返す。存在しないか期限切れの場合はNoneを返す"""
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            expires_at, user_id, value = entry
+            if expires_at <= time.time():
+                self._remove(token, user_id)
+                return None
+            self._entries.move_to_end(token)
+            return value
+
+    def set(self, token: str, user_id: int, value: Any, exp: float) -> None:
+        """値を登録する。有効期限はトークンのexpとTTLのうち早い方になる"""
+        if self.maxsize <= 0:
+            return
+        expires_at = min(exp, time.time() + self.ttl)
+        with self._lock:
+            old = self._entries.pop(token, None)
+            if old is not None:
+                self._remove(token, old[1])
+            self._entries[token] = (expires_at, user_id, value)
+            self._tokens_by_user.setdefault(user_id, set()).add(token)
+            while len(self._entries) > self.maxsize:
+                oldest, (_, oldest_user_id, _) = next(iter(self._entries.items()))
+                self._remove(oldest, oldest_user_id)
+
+    def invalidate_user(self, user_id: int) -> None:
+        """指定したユーザーのエントリをすべて破棄する"""
+        with self._lock:
+            for token in self._tokens_by_user.pop(user_id, set()):
+                self._entries.pop(token, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_user.clear()
+
+    def _remove(self, token: str, user_id: int) -> None:
+        self._entries.pop(token, None)
+        tokens = self._tokens_by_user.get(user_id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[user_id]
+
+
+class TokenVersionCache:
+    """ユーザーごとのトークンバージョン (users.token_version) をプロセス内に保持するキャッシュ
+
+    ステートレスなトークンの失効確認に利用する。
+    他のプロセスでの更新は ttl 秒以内に反映される。
+    """
+
+    def __init__(self, maxsize: int, ttl: int):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # user_id -> (expires_at, version)
+        self._versions: "OrderedDict[int, Tuple[float, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int) -> Optional[int]:
+        with self._lock:
+            entry = self._versions.get(user_id)
+            if entry is None:
+                return None
+            expires_at, version = entry
+            if expires_at <= time.time():
+                del self._versions[user_id]
+                return None
+            self._versions.move_to_end(user_id)
+            return version
+
+    def set(self, user_id: int, version: int) -> None:
+        with self._lock:
+            self._versions[user_id] = (time.time() + self.ttl, version)
+            self._versions.move_to_end(user_id)
+            while len(self._versions) > self.maxsize:
+                self._versions.popitem(last=False)
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._versions.pop(user_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._versions.clear()
@@ -0,0 +1,141 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Any, Dict
+
+from jose import jwk, jwt, JWTError
+
+from env import Environment
+
+
+class InvalidTokenError(Exception):
+    """署名・形式・有効期限のいずれかが不正なトークンを受け取ったときに送出される例外"""
+
+
+class TokenCodec(ABC):
+    """アクセストークンのエンコード・デコードを行うクラスのインターフェース
+
+    keys には kid(鍵ID) -> 秘密鍵 を渡す。
+    エンコードには current_kid の鍵を使い、デコードではトークンに含まれるkidの鍵で検証する。
+    古い鍵を keys に残しておけば、鍵をローテーションしても発行済みのトークンを検証できる。
+    """
+
+    def __init__(self, keys: Dict[str, str], current_kid: str):
+        if current_kid not in keys:
+            raise ValueError(f"Key is not found. (kid={current_kid})")
+        self.current_kid = current_kid
+
+    @abstractmethod
+    def encode(self, claims: Dict[str, Any]) -> str:
+        pass
+
+    @abstractmethod
+    def decode(self, token: str) -> Dict[str, Any]:
+        """トークンを検証してクレームを返す。不正なトークンの場合は InvalidTokenError を送出する"""
+        pass
+
+
+class JWTCodec(TokenCodec):
+    """python-joseを利用したJWT
+
+    鍵は起動時に jwk.construct でKeyオブジェクトに変換しておき、リクエストごとの鍵の解析を省く。
+    """
+
+    def __init__(self, keys: Dict[str, str], current_kid: str, algorithm: str = "HS256"):
+        super().__init__(keys, current_kid)
+        self.algorithm = algorithm
+        self._keys = {kid: jwk.construct(secret, algorithm) for kid, secret in keys.items()}
+
+    def encode(self, claims: Dict[str, Any]) -> str:
+        return jwt.encode(
+            claims,
+            self._keys[self.current_kid],
+            algorithm=self.algorithm,
+            headers={"kid": self.current_kid},
+        )
+
+    def decode(self, token: str) -> Dict[str, Any]:
+        try:
+            # kidを持たないトークンは、kid導入前に現在の鍵で発行されたものとして扱う
+            kid = jwt.get_unverified_header(token).get("kid", self.current_kid)
+            key = self._keys.get(kid)
+            if key is None:
+                raise InvalidTokenError(f"Unknown kid. ({kid})")
+            return jwt.decode(token, key, algorithms=[self.algorithm])
+        except JWTError as e:
+            raise InvalidTokenError(str(e))
+
+
+class CompactCodec(TokenCodec):
+    """HMAC-SHA256で署名したコンパクトなバイナリトークン
+
+    形式: base64url( kidの長さ(1byte) + kid + クレーム(JSON) + 署名(32byte) )
+    JWTのようなヘッダのJSONやセグメントごとのbase64エンコードを持たないため、短く、処理も軽い。
+    鍵ごとにHMACオブジェクトを作っておき、署名のたびに copy() して使う。
+    """
+
+    _DIGEST_SIZE = hashlib.sha256().digest_size
+
+    def __init__(self, keys: Dict[str, str], current_kid: str):
+        super().__init__(keys, current_kid)
+        self._macs = {
+            kid.encode("utf-8"): hmac.new(secret.encode("utf-8"), digestmod=hashlib.sha256)
+            for kid, secret in keys.items()
+        }
+
+    def encode(self, claims: Dict[str, Any]) -> str:
+        kid = self.current_kid.encode("utf-8")
+        claims = {k: int(v.timestamp()) if isinstance(v, datetime) else v for k, v in claims.items()}
+        body = bytes([len(kid)]) + kid + json.dumps(claims, separators=(",", ":")).encode("utf-8")
+        mac = self._macs[kid].copy()
+        mac.update(body)
+        return base64.urlsafe_b64encode(body + mac.digest()).rstrip(b"=").decode("ascii")
+
+    def decode(self, token: str) -> Dict[str, Any]:
+        try:
+            raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        except ValueError:
+            raise InvalidTokenError("Malformed token.")
+        if len(raw) <= self._DIGEST_SIZE + 1:
+            raise InvalidTokenError("Malformed token.")
+        body, signature = raw[:-self._DIGEST_SIZE], raw[-self._DIGEST_SIZE:]
+        kid = body[1:1 + body[0]]
+        base_mac = self._macs.get(kid)
+        if base_mac is None:
+            raise InvalidTokenError("Unknown kid.")
+        mac = base_mac.copy()
+        mac.update(body)
+        if not hmac.compare_digest(mac.digest(), signature):
+            raise InvalidTokenError("Signature verification failed.")
+        try:
+            claims = json.loads(body[1 + body[0]:])
+        except ValueError:
+            raise InvalidTokenError("Malformed token.")
+        if "exp" in claims and claims["exp"] <= time.time():
+            raise InvalidTokenError("Signature has expired.")
+        return claims
+
+
+def parse_keys(value: str) -> Dict[str, str]:
+    """"kid1:secret1,kid2:secret2" 形式の文字列を辞書に変換する"""
+    keys = {}
+    for item in value.split(","):
+        if item.strip():
+            kid, _, secret = item.strip().partition(":")
+            keys[kid] = secret
+    return keys
+
+
+def create_codec(env: Environment) -> TokenCodec:
+    """環境変数の設定からTokenCodecを生成する"""
+    keys = parse_keys(env.token_previous_keys)
+    keys[env.token_key_id] = env.token_secret_key
+    if env.token_codec == "jwt":
+        return JWTCodec(keys, env.token_key_id, env.token_algorithm)
+    if env.token_codec == "compact":
+        return CompactCodec(keys, env.token_key_id)
+    raise ValueError(f"Unknown token codec. ({env.token_codec})")